@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Micro-benchmark of file names matching against a list of patterns, comparing the former
+per-pattern loop against pyrsc compiled PatternMatcher, for --del-files-with/-without.
+"""
+
+import os
+import sys
+import random
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+# Patterns from the README typical series of commands on a console-like ROM set
+README_PATTERNS = "*Hack* * Test * *Preview* *Debugged* *protected* *Proto* *Alternate* *Beta* *Demo * *(Demo)* " \
+                  "*[BIOS]* *Diagnostic* *SDK* *Program* *Sample* *(Pirate)* *Rev 1* *Rev A* *Virtual Console* " \
+                  "*Unl* *Gamecube* *Test Cartridge* *Competition Cart* *(Arcade)* *Switch Online* *Mini)* " \
+                  "*J-Cart* *Online* *Keyboard* *Disc * *NFL * *NHL * *NBA * *ESPN* *NCAA* *Baseball* *chess* " \
+                  "*Mahjong* *Hockey* *golf* *rugby* *LodgeNet* *4 in 1* *4-in-1* *8-in-1* *16-in-1* *32-in-1* " \
+                  "*64-in-1* *128-in-1* *Compilation* *Utils* *ZZZ* *2 in 1* *2-in-1* *2 Games in 1* " \
+                  "*2 Games in One* *2 in 1 Game* *2 Game Pack* *3 Game Pack* *3 Games in One* *3 Games in 1* " \
+                  "*2 Jeux en 1* *2 Great Games* *2 Disney Games* *4 in One* *5 in One*"
+
+WORDS   = ['Super', 'Mario', 'Zelda', 'Golf', 'Quest', 'Dragon', 'Street', 'Fighter', 'Hockey', 'Racing',
+           'Kirby', 'Star', 'Wars', 'Soccer', 'Tennis', 'Puzzle', 'Castle', 'Ninja', 'Turtles', 'Chess']
+REGIONS = ['(Europe)', '(USA)', '(Japan)', '(World)', '(Europe) (En,Fr,De)', '(USA) (Rev 1)', '(Japan) (Proto)',
+           '(USA) (Beta)', '(Europe) (Demo)', '(USA) (Virtual Console)']
+
+
+def generate_names(count):
+
+    names = []
+
+    for index in range(count):
+        title = ' '.join(random.choice(WORDS) for word in range(random.randint(1, 4)))
+        names.append(title + ' ' + random.choice(REGIONS) + '.zip')
+
+    return names
+
+
+def loop_any(names, patterns):
+
+    matches = 0
+    for name in names:
+        for pattern in patterns:
+            if pattern.lower() in name.lower():
+                matches += 1
+                break
+
+    return matches
+
+
+def loop_all(names, patterns):
+
+    matches = 0
+    for name in names:
+        for pattern in patterns:
+            if not pattern.lower() in name.lower():
+                break
+        else:
+            matches += 1
+
+    return matches
+
+
+def matcher_any(names, patterns):
+
+    matcher = pyrsc.PatternMatcher(patterns)
+    matches = 0
+    for name in names:
+        if matcher.search(name):
+            matches += 1
+
+    return matches
+
+
+def matcher_all(names, patterns):
+
+    matcher = pyrsc.PatternMatcher(patterns)
+    matches = 0
+    for name in names:
+        if matcher.matches_all(name):
+            matches += 1
+
+    return matches
+
+
+def run(function, names, patterns):
+
+    start   = time.perf_counter()
+    matches = function(names, patterns)
+
+    return time.perf_counter() - start, matches
+
+
+def main(argv=None):
+
+    parser = OptionParser(usage='usage: %prog [-h] [--sizes=LIST] [--seed=INT]')
+    parser.add_option("--sizes",
+                      action="store",
+                      dest="sizes",
+                      default="10000,100000,1000000",
+                      help="comma separated counts of names to be matched [default: %default]",
+                      metavar="LIST")
+    parser.add_option("--seed",
+                      action="store",
+                      dest="seed",
+                      default="0",
+                      help="random seed used to generate names [default: %default]",
+                      metavar="INT")
+    (opts, args) = parser.parse_args(argv)
+
+    random.seed(int(opts.seed))
+    pyrsc.LOG_LEVEL = -1
+    any_patterns = pyrsc.check_and_get_patterns_list(README_PATTERNS)
+    all_patterns = pyrsc.check_and_get_patterns_list("*(* *)* *.zip*")
+
+    print("%d patterns for --del-files-with, %d for --del-files-without" % (len(any_patterns), len(all_patterns)))
+    print("%10s  %-14s %10s %10s %8s" % ("names", "mode", "loop (s)", "matcher (s)", "speedup"))
+
+    for size in [int(size) for size in opts.sizes.split(',')]:
+        names = generate_names(size)
+        for mode, loop_function, matcher_function, patterns in (("with/any", loop_any, matcher_any, any_patterns),
+                                                                ("without/all", loop_all, matcher_all, all_patterns)):
+            loop_time, loop_matches       = run(loop_function, names, patterns)
+            matcher_time, matcher_matches = run(matcher_function, names, patterns)
+            if loop_matches != matcher_matches:
+                print("ERROR: %s matches differ: %d vs %d" % (mode, loop_matches, matcher_matches))
+                return 1
+            print("%10d  %-14s %10.3f %10.3f %7.1fx" % (size, mode, loop_time, matcher_time, loop_time / matcher_time))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark suite of pyrsc cleaning operations, run over generated ROM sets: No-Intro/TOSEC-like
+file names trees with scraped images, and MAME-like .dat files with BIOS, clones and samples,
+along with their ZIP archives. Each operation runs in a child process, so that its wall time,
+CPU time, peak RSS growth and I/O syscalls are measured alone, once its inputs are ready;
+results are saved as JSON, so that runs of different versions can be compared with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import zipfile
+import zlib
+import platform
+import tempfile
+import multiprocessing
+import queue as queue_module
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+# Version of results files format, to be increased whenever results change
+RESULTS_VERSION = 2
+
+SYSTEMS  = ['Nintendo - Game Boy', 'Sega - Mega Drive', 'Atari - 2600', 'NEC - PC Engine']
+WORDS    = ['Super', 'Mario', 'Zelda', 'Golf', 'Quest', 'Dragon', 'Street', 'Fighter', 'Hockey', 'Racing',
+            'Kirby', 'Star', 'Wars', 'Soccer', 'Tennis', 'Puzzle', 'Castle', 'Ninja', 'Turtles', 'Chess']
+REGIONS  = ['(Europe)', '(USA)', '(Japan)', '(World)', '(Europe) (En,Fr,De)', '(USA, Europe)', '(France)',
+            '(Europe) (PAL)', '(Germany) (SECAM)', '(Japan, USA)']
+FLAGS    = ['', '', '', '', ' (Rev 1)', ' (Rev A)', ' (Beta)', ' (Proto)', ' (Demo)', ' [!]', ' (Hack)']
+BIOSES   = ['neogeo', 'pgm', 'nmk004', 'cps3', 'decocass']
+MAKERS   = ['Capcom', 'SNK', 'Konami', 'Taito', 'Sega', 'Namco', 'bootleg', 'hack']
+COMMENTS = ['', '', '', 'imperfect sound', 'demo mode broken', 'protection not emulated']
+
+FILES_WITH    = "*(Beta)* *(Proto)* *(Demo)* *(Hack)*"
+FILES_WITHOUT = "*(* *)* *.zip*"
+DESCRIPTIONS  = "*bootleg* *hack* *prototype* *japan*"
+
+
+# Write a ROM file with small random content, some of them sharing the same content
+def write_rom(path, rng, duplicates):
+
+    if duplicates and rng.random() < 0.05:
+        content = rng.choice(duplicates)
+    else:
+        content = bytes(rng.getrandbits(8) for byte in range(rng.randint(16, 64)))
+        if len(duplicates) < 100:
+            duplicates.append(content)
+    with open(path, 'wb') as rom_file:
+        rom_file.write(content)
+
+
+# Generate a console-like ROM set: a directory per system and initial letter, titles with
+# several region/revision variants, and PNG images in media/images for most of them
+def generate_console_set(path, count, rng):
+
+    duplicates = []
+    index      = 0
+    while index < count:
+        title   = ' '.join(rng.choice(WORDS) for word in range(rng.randint(1, 4))) + ' ' + str(index)
+        dirname = os.path.join(path, rng.choice(SYSTEMS), title[0])
+        os.makedirs(os.path.join(dirname, 'media', 'images'), exist_ok=True)
+        for variant in range(min(rng.randint(1, 4), count - index)):
+            name = title + ' ' + rng.choice(REGIONS) + rng.choice(FLAGS)
+            if os.path.exists(os.path.join(dirname, name + '.zip')):
+                name += ' (Alt ' + str(variant) + ')'
+            write_rom(os.path.join(dirname, name + '.zip'), rng, duplicates)
+            if rng.random() < 0.8:
+                open(os.path.join(dirname, 'media', 'images', name + '.png'), 'wb').close()
+            index += 1
+        if rng.random() < 0.02:
+            open(os.path.join(dirname, 'media', 'images', title + ' (Deleted).png'), 'wb').close()
+
+
+# Generate a MAME-like ROM set: a .dat file with BIOS, parents, clones and games with samples,
+# and a ZIP archive per game, some of them missing ROMs or having a wrong one
+def generate_arcade_set(path, count, rng):
+
+    os.makedirs(path, exist_ok=True)
+    path_to_dat_file = os.path.join(path, 'arcade.dat')
+
+    with open(path_to_dat_file, 'w', encoding='utf-8') as dat_file:
+        dat_file.write('<?xml version="1.0"?>\n<datafile>\n')
+        parents = []
+        for index in range(count):
+            if index < len(BIOSES):
+                name       = BIOSES[index]
+                attributes = ' isbios="yes"'
+            else:
+                name       = 'g%07d' % index
+                attributes = ''
+                if parents and rng.random() < 0.4:
+                    parent      = rng.choice(parents)
+                    attributes += ' cloneof="%s" romof="%s"' % (parent, parent)
+                else:
+                    parents.append(name)
+                    if rng.random() < 0.5:
+                        attributes += ' romof="%s"' % rng.choice(BIOSES)
+                if rng.random() < 0.05:
+                    attributes += ' sampleof="%s"' % name
+            roms = []
+            for rom in range(2):
+                content = bytes(rng.getrandbits(8) for byte in range(16))
+                roms.append(('%s_%d.bin' % (name, rom), content))
+            dat_file.write('<game name="%s"%s><description>%s %s</description><year>%d</year>'
+                           '<manufacturer>%s</manufacturer><comment>%s</comment>'
+                           % (name, attributes, rng.choice(WORDS), rng.choice(['', '(bootleg)', '(prototype)', '(Japan)']),
+                              rng.randint(1978, 2005), rng.choice(MAKERS), rng.choice(COMMENTS)))
+            for rom_name, content in roms:
+                dat_file.write('<rom name="%s" size="%d" crc="%08x"/>' % (rom_name, len(content), zlib.crc32(content)))
+            if 'sampleof' in attributes:
+                dat_file.write('<sample name="s1"/>')
+            dat_file.write('</game>\n')
+            with zipfile.ZipFile(os.path.join(path, name + '.zip'), 'w') as zip_file:
+                for rom_name, content in roms:
+                    luck = rng.random()
+                    if luck < 0.02:
+                        continue
+                    elif luck < 0.04:
+                        content = content[::-1]
+                    zip_file.writestr(rom_name, content)
+        dat_file.write('</datafile>\n')
+
+    return path_to_dat_file
+
+
+def get_corpus(path, count, rng):
+
+    corpus = {'console': os.path.join(path, 'console'),
+              'reference': os.path.join(path, 'reference'),
+              'arcade': os.path.join(path, 'arcade')}
+
+    generate_console_set(corpus['console'], count, rng)
+    generate_console_set(corpus['reference'], max(count // 10, 1), rng)
+    corpus['dat'] = generate_arcade_set(corpus['arcade'], count, rng)
+
+    return corpus
+
+
+# Load a .dat file with the selected store, parsing it (or scanning it, for the lazy store)
+# rather than reading its cache
+def load_dat(path_to_dat_file, with_roms=False):
+
+    pyrsc.USE_DAT_CACHE = False
+
+    return pyrsc.get_dat_index(path_to_dat_file, with_roms)
+
+
+# Operations to be timed: (name, ROMs directory, .dat file needed, function run on inventory);
+# cleaning operations run in dry-run mode, so that all of them see the same ROM set
+def get_operations(corpus):
+
+    console, arcade, dat = corpus['console'], corpus['arcade'], corpus['dat']
+    references           = [corpus['reference']]
+
+    return [
+        ('load_dat',                 arcade,  None, lambda inventory: load_dat(dat)),
+        ('load_dat_roms',            arcade,  None, lambda inventory: load_dat(dat, with_roms=True)),
+        ('scan',                     console, None, lambda inventory: pyrsc.Inventory(console).scan()),
+        ('del_files_with',           console, None, lambda inventory: pyrsc.del_files_with(inventory, FILES_WITH)),
+        ('del_files_without',        console, None, lambda inventory: pyrsc.del_files_without(inventory, FILES_WITHOUT)),
+        ('del_ntsc_versions',        console, None, lambda inventory: pyrsc.del_pal_or_ntsc_files(inventory, True)),
+        ('del_pal_versions',         console, None, lambda inventory: pyrsc.del_pal_or_ntsc_files(inventory, False)),
+        ('del_roms_without_image',   console, None, lambda inventory: pyrsc.del_roms_without_image(inventory)),
+        ('del_images_without_rom',   console, None, lambda inventory: pyrsc.del_images_without_rom(inventory)),
+        ('del_first_variants',       console, None, lambda inventory: pyrsc.del_variant_files(inventory, True)),
+        ('del_last_variants',        console, None, lambda inventory: pyrsc.del_variant_files(inventory, False)),
+        ('del_variants_with',        console, None, lambda inventory: pyrsc.del_variant_files_from_string(inventory, "*Japan*", True)),
+        ('del_variants_without',     console, None, lambda inventory: pyrsc.del_variant_files_from_string(inventory, "*Europe*", False)),
+        ('del_content_duplicates',   console, None, lambda inventory: pyrsc.del_content_duplicates(inventory, None, references)),
+        ('del_duplicates',           arcade,  dat,  lambda inventory: pyrsc.del_duplicates(inventory, dat, [console])),
+        ('del_roms_clones',          arcade,  dat,  lambda inventory: pyrsc.del_roms_clones(inventory, dat)),
+        ('del_roms_with_samples',    arcade,  dat,  lambda inventory: pyrsc.del_roms_with_samples(inventory, dat)),
+        ('del_roms_older_than',      arcade,  dat,  lambda inventory: pyrsc.del_roms_older_than(inventory, dat, "1990")),
+        ('del_if_description_has',   arcade,  dat,  lambda inventory: pyrsc.del_if_description_has(inventory, dat, DESCRIPTIONS)),
+        ('del_if_manufacturer_has',  arcade,  dat,  lambda inventory: pyrsc.del_if_manufacturer_has(inventory, dat, "*hack* *bootleg*")),
+        ('del_if_comment_has',       arcade,  dat,  lambda inventory: pyrsc.del_if_comment_has(inventory, dat, "*imperfect* *broken*")),
+        ('del_if_bios_is',           arcade,  dat,  lambda inventory: pyrsc.del_if_bios_is(inventory, dat, "pgm", True)),
+        ('del_if_bios_isnt',         arcade,  dat,  lambda inventory: pyrsc.del_if_bios_is(inventory, dat, "neogeo", False)),
+        ('audit_zips',               arcade,  dat,  lambda inventory: pyrsc.audit_zips(inventory, dat, False)),
+        ('make_flat_dry_run',        console, None, lambda inventory: pyrsc.make_flat(console, 'rename')),
+    ]
+
+
+def get_io_syscalls():
+
+    counts = {}
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                key, value = line.split(':')
+                counts[key] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counts.get('syscr'), counts.get('syscw')
+
+
+# Get resident set size and its peak, in KiB (Linux only)
+def get_rss():
+
+    sizes = {}
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                key, value = line.split(':', 1)
+                if key in ('VmRSS', 'VmHWM'):
+                    sizes[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+
+    return sizes.get('VmRSS'), sizes.get('VmHWM')
+
+
+# Reset peak resident set size to the current one (Linux only); get True if it was reset
+def reset_peak_rss():
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_file:
+            clear_refs_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_max_rss():
+
+    # Peak RSS is in KiB on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+
+# Run an operation in the current (child) process, its inputs being prepared first; it is
+# found again by name, as operations cannot be passed to spawned processes
+def run_operation(operation_name, corpus, cache_dir, dat_store, queue):
+
+    name, path_to_roms_dir, path_to_dat_file, function = \
+        [operation for operation in get_operations(corpus) if operation[0] == operation_name][0]
+
+    pyrsc.LOG_LEVEL        = -1
+    pyrsc.IS_DRY_RUN       = True
+    pyrsc.USE_DIGEST_CACHE = False
+    pyrsc.DAT_STORE        = dat_store
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+
+    # Only the operation itself is measured, not the scan nor the .dat file parsing it needs
+    inventory = pyrsc.Inventory(path_to_roms_dir).scan()
+    if path_to_dat_file:
+        pyrsc.get_dat_index(path_to_dat_file, with_roms=(name == 'audit_zips'))
+
+    # Peak RSS reached by the scan and the .dat file parsing is reset when supported, so that
+    # only the growth of RSS over the one of ready inputs is reported
+    is_peak_reset = reset_peak_rss()
+    start_rss     = get_rss()[0]
+    start_max_rss = get_max_rss() if resource else None
+
+    syscr, syscw = get_io_syscalls()
+    start_time   = time.perf_counter()
+    start_cpu    = time.process_time()
+
+    function(inventory)
+
+    result = {'operation':  name,
+              'wall_s':     time.perf_counter() - start_time,
+              'cpu_s':      time.process_time() - start_cpu,
+              'deleted':    pyrsc.DELETED_FILES_COUNT}
+    end_syscr, end_syscw = get_io_syscalls()
+    if syscr is not None and end_syscr is not None:
+        result['read_syscalls']  = end_syscr - syscr
+        result['write_syscalls'] = end_syscw - syscw
+    end_hwm = get_rss()[1]
+    if is_peak_reset and start_rss is not None and end_hwm is not None:
+        result['peak_rss_growth_kb'] = end_hwm - start_rss
+    elif resource:
+        # With no reset, only a peak above the one of inputs preparation is found
+        result['peak_rss_growth_kb'] = get_max_rss() - start_max_rss
+
+    queue.put(result)
+
+
+# Measure an operation in a child process; an operation whose process ends with no result,
+# e.g. on an exception, is recorded as failed along with the exit code of its process
+def measure(operation_name, corpus, cache_dir, dat_store):
+
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    queue   = context.Queue()
+    process = context.Process(target=run_operation, args=(operation_name, corpus, cache_dir, dat_store, queue))
+    process.start()
+
+    # A result put just before the process ended is still found in the queue
+    result = None
+    while result is None and (process.is_alive() or not queue.empty()):
+        try:
+            result = queue.get(timeout=1)
+        except queue_module.Empty:
+            pass
+    process.join()
+
+    if result is None:
+        result = {'operation': operation_name,
+                  'failed':    True,
+                  'exitcode':  process.exitcode}
+
+    return result
+
+
+def print_comparison(results, path_to_previous_results):
+
+    with open(path_to_previous_results, encoding='utf-8') as results_file:
+        previous = json.load(results_file)
+    previous_times = {(result['size'], result['operation']): result['wall_s'] for result in previous['results']
+                      if not result.get('failed')}
+
+    print("\nCompared to " + path_to_previous_results + " (pyrsc " + str(previous.get('pyrsc_version')) + "):")
+    print("%10s  %-26s %10s %10s %8s" % ("files", "operation", "before (s)", "after (s)", "ratio"))
+    for result in results:
+        key = (result['size'], result['operation'])
+        if key in previous_times and not result.get('failed') and result['wall_s'] > 0:
+            print("%10d  %-26s %10.3f %10.3f %7.2fx" % (key[0], key[1], previous_times[key], result['wall_s'],
+                                                        previous_times[key] / result['wall_s']))
+
+
+def main(argv=None):
+
+    parser = OptionParser(usage='usage: %prog [-h] [--sizes=LIST] [--operations=LIST] [--seed=INT] '
+                                '[--output=FILE] [--compare=FILE] [--work-dir=DIR] [--dat-store=STRING]')
+    parser.add_option("--sizes",
+                      action="store",
+                      dest="sizes",
+                      default="1000,10000,100000,1000000",
+                      help="comma separated counts of files of generated ROM sets [default: %default]",
+                      metavar="LIST")
+    parser.add_option("--operations",
+                      action="store",
+                      dest="operations",
+                      help="comma separated names of operations to be timed [default: all]",
+                      metavar="LIST")
+    parser.add_option("--seed",
+                      action="store",
+                      dest="seed",
+                      default="0",
+                      help="random seed used to generate ROM sets [default: %default]",
+                      metavar="INT")
+    parser.add_option("--output",
+                      action="store",
+                      dest="output",
+                      default="bench_results.json",
+                      help="JSON file the results are written to [default: %default]",
+                      metavar="FILE")
+    parser.add_option("--compare",
+                      action="store",
+                      dest="compare",
+                      help="JSON results file of a previous run, to be compared with",
+                      metavar="FILE")
+    parser.add_option("--work-dir",
+                      action="store",
+                      dest="work_dir",
+                      help="directory where ROM sets are generated, and kept [default: a temporary directory]",
+                      metavar="DIR")
+    parser.add_option("--dat-store",
+                      action="store",
+                      dest="dat_store",
+                      default=pyrsc.DAT_STORE,
+                      help="how .dat file games are held in memory: 'index', 'columns' or 'lazy' [default: %default]",
+                      metavar="STRING")
+    (opts, args) = parser.parse_args(argv)
+
+    work_dir = opts.work_dir or tempfile.mkdtemp(prefix='pyrsc-bench-')
+    results  = []
+
+    print("%10s  %-26s %10s %10s %16s %12s %10s" % ("files", "operation", "wall (s)", "cpu (s)", "RSS growth (KiB)",
+                                                    "I/O syscalls", "deleted"))
+
+    try:
+        for size in [int(size) for size in opts.sizes.split(',')]:
+            path = os.path.join(work_dir, str(size))
+            if not os.path.isdir(path):
+                start = time.perf_counter()
+                corpus = get_corpus(path, size, random.Random(int(opts.seed)))
+                print("%10d  %-26s %10.3f" % (size, "(generation)", time.perf_counter() - start))
+            else:
+                corpus = {'console': os.path.join(path, 'console'), 'reference': os.path.join(path, 'reference'),
+                          'arcade': os.path.join(path, 'arcade'), 'dat': os.path.join(path, 'arcade', 'arcade.dat')}
+
+            cache_dir = os.path.join(path, 'cache')
+            for operation in get_operations(corpus):
+                if opts.operations and operation[0] not in opts.operations.split(','):
+                    continue
+                result = measure(operation[0], corpus, cache_dir, opts.dat_store)
+                result['size'] = size
+                results.append(result)
+                if result.get('failed'):
+                    print("%10d  %-26s %10s (exit code %s)" % (size, result['operation'], "failed", result['exitcode']))
+                    continue
+                syscalls = result.get('read_syscalls', 0) + result.get('write_syscalls', 0) \
+                    if 'read_syscalls' in result else -1
+                print("%10d  %-26s %10.3f %10.3f %16s %12s %10d" % (size, result['operation'], result['wall_s'], result['cpu_s'],
+                                                                    result.get('peak_rss_growth_kb', '-'), syscalls, result['deleted']))
+    finally:
+        if not opts.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(opts.output, 'w', encoding='utf-8') as results_file:
+        json.dump({'version': RESULTS_VERSION,
+                   'pyrsc_version': pyrsc.__version__,
+                   'pyrsc_updated': pyrsc.__updated__,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'jobs': pyrsc.JOBS_COUNT,
+                   'dat_store': opts.dat_store,
+                   'seed': int(opts.seed),
+                   'results': results}, results_file, indent=1)
+    print("\nResults written to: " + opts.output)
+
+    if opts.compare:
+        print_comparison(results, opts.compare)
+
+    if any(result.get('failed') for result in results):
+        return 2
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
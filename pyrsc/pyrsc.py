@@ -8,9 +8,35 @@ Python-based ROMs Set Cleaner, to help and clean large ROM sets from undesired R
 import os
 import os.path
 import shutil
-import glob
+import errno
 import sys
 import re
+import hashlib
+import pickle
+import json
+import time
+import contextlib
+import signal
+import atexit
+import tempfile
+import zipfile
+import zlib
+import array
+import operator
+import mmap
+import html
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from optparse import OptionParser
 from xml.etree import ElementTree
 
@@ -31,142 +57,2011 @@ REQUIRED_PYTHON_VERSION = 3
 # Count of (possibly) deleted files
 DELETED_FILES_COUNT = 0
 
+# Tags of ROMs for 50Hz TV standards, e.g. (PAL), (PAL-M) or (SECAM); any other ROM, e.g.
+# tagged (NTSC), (NTSC-J) or not tagged at all, is considered as a NTSC version
+PAL_TAG_REGEX = re.compile(r"\((?:PAL|SECAM)")
 
-# Just show log message on STDERR, if log level is enough
+# Tags of ROM names, e.g. (Europe), (Rev 1), (En,Fr) in No-Intro/TOSEC names, and flags,
+# e.g. [!], [a2] or [o1] in TOSEC/GoodTools names
+ROM_NAME_TAG_REGEX = re.compile(r"\(([^()]*)\)|\[([^\[\]]*)\]")
+
+# Separators of several regions or languages in a single tag, e.g. (USA, Europe), (En,Fr), (US-EU)
+ROM_NAME_TAG_SEPARATOR_REGEX = re.compile(r"\s*[,+-]\s*")
+
+# Revision tags, e.g. (Rev 1), (Rev A), (v1.1), (v2.0a)
+ROM_NAME_REVISION_REGEX = re.compile(r"^(?:Rev\s*([0-9A-Za-z.]+)|v([0-9][0-9.]*[a-z]?))$")
+
+# Language tags items, e.g. En, Fr, Pt-BR, or en, fr in TOSEC names
+ROM_NAME_LANGUAGE_REGEX = re.compile(r"^[A-Za-z][a-z](?:-[A-Za-z]{2})?$")
+
+# Regions of ROM names, as written by No-Intro, and as coded by TOSEC and GoodTools
+REGIONS = {'World': 'World', 'Europe': 'Europe', 'Asia': 'Asia', 'USA': 'USA', 'Japan': 'Japan',
+           'Australia': 'Australia', 'Brazil': 'Brazil', 'Canada': 'Canada', 'China': 'China',
+           'France': 'France', 'Germany': 'Germany', 'Hong Kong': 'Hong Kong', 'Italy': 'Italy',
+           'Korea': 'Korea', 'Netherlands': 'Netherlands', 'Russia': 'Russia', 'Spain': 'Spain',
+           'Sweden': 'Sweden', 'Taiwan': 'Taiwan', 'United Kingdom': 'United Kingdom', 'UK': 'United Kingdom',
+           'US': 'USA', 'EU': 'Europe', 'JP': 'Japan', 'AU': 'Australia', 'BR': 'Brazil', 'CA': 'Canada',
+           'CN': 'China', 'FR': 'France', 'DE': 'Germany', 'HK': 'Hong Kong', 'IT': 'Italy', 'KR': 'Korea',
+           'NL': 'Netherlands', 'RU': 'Russia', 'ES': 'Spain', 'SE': 'Sweden', 'TW': 'Taiwan', 'GB': 'United Kingdom'}
+GOODTOOLS_REGIONS = {'W': 'World', 'E': 'Europe', 'U': 'USA', 'J': 'Japan', 'A': 'Australia', 'B': 'Brazil',
+                     'C': 'China', 'F': 'France', 'G': 'Germany', 'H': 'Netherlands', 'I': 'Italy', 'K': 'Korea',
+                     'S': 'Spain'}
+
+# Directories where scrapers save images of ROMs, under ROMs directories
+MEDIA_IMAGES_DIRS = (os.path.join('media', 'images'),
+                     os.path.join('media', 'screenshots'),
+                     os.path.join('media', 'box2d'))
+
+# Extensions of scraped images
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Use .dat cache files, to avoid parsing again an unchanged .dat file
+USE_DAT_CACHE = True
+
+# Ignore existing .dat cache files, parse .dat files again and refresh their cache
+REBUILD_DAT_CACHE = False
+
+# Version of .dat cache files format, to be increased whenever cached data change
+DAT_CACHE_VERSION = 3
+
+# Store .dat files games are loaded into: 'index' of game records, 'columns' of arrays, or
+# 'lazy' index of games offsets in the .dat file, each game being parsed once looked up
+DAT_STORE = 'index'
+
+# Year of games having a year in .dat file which is no integer, e.g. "198?", so that they
+# are deemed older than any year; games with no year at all are never deemed older
+UNKNOWN_YEAR = 0
+
+# Use the files digests cache, to avoid reading again unchanged files
+USE_DIGEST_CACHE = True
+
+# Count of concurrent jobs for I/O bound operations, e.g. files hashing
+JOBS_COUNT = 8
+
+# Version of plan files format, to be increased whenever plan entries change
+PLAN_VERSION = 1
+
+# Version of statistics JSON files format, to be increased whenever statistics change
+STATS_VERSION = 1
+
+# Count of files deleted by a single job, so that large directories are shared among jobs
+DELETE_BATCH_SIZE = 256
+
+# Size of the beginning of files hashed first, to cheaply tell most different files apart
+PARTIAL_HASH_SIZE = 64 * 1024
+
+
+# Format of output lines: 'text', or 'jsonl' for a JSON object per line
+LOG_FORMAT = 'text'
+
+# Show a progress line instead of a line per file
+SHOW_PROGRESS = False
+
+# Output lines not written yet, flushed at phases boundaries, on exit, or once numerous enough
+LOG_BUFFER      = []
+LOG_BUFFER_SIZE = 1000
+
+# Cleaning rule being run, reported along with its actions
+CURRENT_RULE = None
+
+# Minimum delay in seconds between two updates of the progress line
+PROGRESS_INTERVAL = 0.2
+
+
+# Progress of the current rule, shown on a single line of STDERR, at most a few times a second
+class Progress:
+
+    def __init__(self):
+
+        self.counts    = {}
+        self.last_time = 0.0
+        self.is_shown  = False
+
+    def add(self, action):
+
+        self.counts[action] = self.counts.get(action, 0) + 1
+        now = time.monotonic()
+        if now - self.last_time >= PROGRESS_INTERVAL:
+            self.last_time = now
+            self.show()
+
+    def show(self):
+
+        # Redirected outputs are not cluttered with progress lines
+        if not sys.stderr.isatty():
+            return
+
+        counts = ", ".join(action + ": " + str(count) for action, count in sorted(self.counts.items()))
+        sys.stderr.write("\r\033[K" + (CURRENT_RULE or "pyrsc") + " - " + counts)
+        sys.stderr.flush()
+        self.is_shown = True
+
+    def clear(self):
+
+        if self.is_shown:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+            self.is_shown = False
+
+
+PROGRESS = Progress()
+
+
+# Write buffered output lines, at once
+def flush_log():
+
+    if LOG_BUFFER:
+        PROGRESS.clear()
+        lines = ''.join(LOG_BUFFER)
+        del LOG_BUFFER[:]
+        sys.stdout.write(lines)
+    sys.stdout.flush()
+
+
+def write_log_line(line):
+
+    LOG_BUFFER.append(line + '\n')
+    if len(LOG_BUFFER) >= LOG_BUFFER_SIZE:
+        flush_log()
+
+
+# Just show log message on STDOUT, if log level is enough
 def log(level, message):
 
-    if LOG_LEVEL >= level:
-        sys.stdout.flush()
-        sys.stdout.write(message + '\n')
-        sys.stdout.flush()
+    if LOG_LEVEL >= level:
+        if LOG_FORMAT == 'jsonl':
+            write_log_line(json.dumps({'action': 'message', 'level': level, 'message': message}))
+        else:
+            write_log_line(message)
+
+
+# Report an action on a file, e.g. 'delete', as a text message or a JSON object holding its
+# path, reason and cleaning rule; with a progress line, the action is only counted
+def log_action(level, action, path, reason, message):
+
+    if SHOW_PROGRESS:
+        PROGRESS.add(action)
+    elif LOG_LEVEL >= level:
+        if LOG_FORMAT == 'jsonl':
+            write_log_line(json.dumps({'action': action, 'path': path, 'reason': reason, 'rule': CURRENT_RULE}))
+        else:
+            write_log_line(message)
+
+
+# Flush output on termination signals, then exit as the signal would
+def on_signal(signal_number, frame):
+
+    flush_log()
+    PROGRESS.clear()
+    sys.exit(128 + signal_number)
+
+
+# Statistics of the run, only collected when requested; see Stats
+STATS = None
+
+
+# Wall and CPU times of the phases of the run, and counters of what was done, e.g. files
+# scanned or deleted; phases are listed in start order, a nested phase after its parent
+class Stats:
+
+    def __init__(self):
+
+        self.phases   = []
+        self.counters = {}
+        self.depth    = 0
+
+    def count(self, counter, value=1):
+
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def report(self, is_table_printed, path_to_json_file):
+
+        if is_table_printed:
+            log(0, "\n%-40s %10s %10s" % ("Phase", "Wall (s)", "CPU (s)"))
+            for record in self.phases:
+                log(0, "%-40s %10.3f %10.3f" % ("  " * record['depth'] + record['name'], record['wall_s'], record['cpu_s']))
+            log(0, "\n%-40s %10s" % ("Counter", "Value"))
+            for counter in sorted(self.counters):
+                log(0, "%-40s %10d" % (counter, self.counters[counter]))
+
+        if path_to_json_file:
+            with open(path_to_json_file, 'w', encoding='utf-8') as json_file:
+                json.dump({'version': STATS_VERSION, 'phases': self.phases, 'counters': self.counters}, json_file, indent=1)
+
+        return 0
+
+
+# Record wall and CPU times of a phase, along with counters increased meanwhile; this costs
+# nothing but a test when statistics are not requested
+@contextlib.contextmanager
+def phase(name):
+
+    flush_log()
+
+    if STATS is None:
+        try:
+            yield
+        finally:
+            flush_log()
+        return
+
+    record   = {'name': name, 'depth': STATS.depth}
+    counters = dict(STATS.counters)
+    STATS.phases.append(record)
+    STATS.depth += 1
+    start_wall = time.perf_counter()
+    start_cpu  = time.process_time()
+
+    try:
+        yield
+    finally:
+        record['wall_s']   = time.perf_counter() - start_wall
+        record['cpu_s']    = time.process_time() - start_cpu
+        record['counters'] = {counter: value - counters.get(counter, 0) for counter, value in STATS.counters.items()
+                              if value != counters.get(counter, 0)}
+        STATS.depth -= 1
+        flush_log()
+
+
+# Run input function on all input items with a pool of JOBS_COUNT threads; get a list of
+# (item, result, error) in input order, so that a file error does not stop other jobs
+def run_jobs(function, items):
+
+    def run_job(item):
+        try:
+            return item, function(item), None
+        except OSError as error:
+            return item, None, error
+
+    with ThreadPoolExecutor(max_workers=JOBS_COUNT) as executor:
+        return list(executor.map(run_job, items))
+
+
+# Get a name not in input set of lowered names, numbering input name before its extension
+def get_free_name(filename, names):
+
+    name, extension = os.path.splitext(filename)
+    index = 1
+    while (name + " (" + str(index) + ")" + extension).lower() in names:
+        index += 1
+
+    return name + " (" + str(index) + ")" + extension
+
+
+# Move a file with a single rename when on the same device, else fall back to a copy; an
+# existing destination is never replaced, as a rename would silently do on POSIX systems
+def move_file(source, destination):
+
+    if os.path.lexists(destination):
+        raise FileExistsError(errno.EEXIST, "destination already exists", destination)
+
+    try:
+        os.rename(source, destination)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+
+
+def make_flat(path_to_roms_dir, on_conflict, plan=None):
+
+    path_to_roms_dir = os.path.normpath(path_to_roms_dir)
+
+    # Names already used under the base directory, including the ones of files moved up;
+    # they are lowered, as names only differing by case conflict on case-insensitive file systems
+    names = set(name.lower() for name in os.listdir(path_to_roms_dir))
+
+    # Plan all moves up front, in a deterministic order, so that conflicts are resolved the same way on each run
+    inventory = Inventory(path_to_roms_dir).scan()
+    files_by_dir = {}
+    for file in inventory.files:
+        files_by_dir.setdefault(file.parent_dir, []).append(file)
+    # Sorting paths by their components lists parents first, then sorted subdirectories
+    dirs = sorted(inventory.dirs[1:], key=lambda dirname: os.path.relpath(dirname, path_to_roms_dir).split(os.sep))
+
+    moves = []
+    for dirname in dirs:
+        for file in sorted(files_by_dir.get(dirname, []), key=lambda file: file.name):
+            full_path = file.full_name
+            filename  = file.name
+            if filename.lower() in names:
+                if on_conflict == 'skip':
+                    log_action(1, 'skip-move', full_path, "name already exists",
+                               "Will not move up file, as it already exists: " + full_path)
+                    continue
+                filename = get_free_name(filename, names)
+                log_action(1, 'rename', full_path, "name already exists, moved up as " + filename,
+                           "Will move up file as " + filename + ", as it already exists: " + full_path)
+            names.add(filename.lower())
+            moves.append((full_path, os.path.join(path_to_roms_dir, filename)))
+            if plan is not None:
+                plan.add_move(file, moves[-1][1])
+
+    for source, destination in moves:
+        if IS_DRY_RUN:
+            log_action(2, 'would-move', source, None, "Would move up file: " + source)
+        else:
+            log_action(2, 'move', source, None, "Moving up file: " + source)
+
+    if not IS_DRY_RUN:
+        for move, result, error in run_jobs(lambda move: move_file(*move), moves):
+            if error:
+                log(0, "ERROR: could not move up file " + move[0] + ": " + str(error))
+
+    if STATS is not None:
+        STATS.count('files_moved', len(moves))
+
+    # Subdirectories are listed parents first, so remove them the other way round
+    for dirname in reversed(dirs):
+        if IS_DRY_RUN:
+            log(1, "Would remove directory: " + dirname)
+            if plan is not None:
+                plan.add_removed_dir(dirname)
+        else:
+            try:
+                os.rmdir(dirname)
+                log(0, "Removing directory: " + dirname)
+            except OSError:
+                log(1, "Will not remove directory, as it is not empty: " + dirname)
+
+    return 0
+
+
+def check_and_get_patterns_list(list_string, is_verbose=True):
+
+    list = []
+
+    matches = re.search(r"^(\*[^\*]+\*\s*)+$", list_string)
+    if not matches:
+        log(0, "ERROR: badly formatted input list of patterns; shall be like \"*pattern1* *pattern2*\"")
+    else:
+        matches = re.findall(r"\*[^\*]+\*", list_string)
+        if not matches:
+            log(0, "ERROR: badly formatted input list of patterns; shall be like \"*pattern1* *pattern2*\"")
+        else:
+            for match in matches:
+                pattern = match.replace("*", "")
+                if is_verbose:
+                    log(2, "Adding pattern: '" + pattern + "'")
+                list.append(pattern)
+
+    return list
+
+
+# Get a regular expression matching any of input strings, shaped like a trie of them, so
+# that common prefixes are tested once and the longest string is matched at any position
+def get_trie_regex(strings):
+
+    trie = {}
+    for string in strings:
+        node = trie
+        for character in string:
+            node = node.setdefault(character, {})
+        node[''] = True
+
+    def get_node_regex(node):
+
+        alternatives = [re.escape(character) + get_node_regex(node[character]) for character in sorted(node) if character]
+        if not alternatives:
+            return ''
+        elif '' in node:
+            return '(?:' + '|'.join(alternatives) + ')?'
+        elif len(alternatives) == 1:
+            return alternatives[0]
+        else:
+            return '(?:' + '|'.join(alternatives) + ')'
+
+    return get_node_regex(trie)
+
+
+# Case-insensitive matcher of a list of patterns, compiled once, rather than lowering and
+# looking for each pattern, one after the other, in each name
+class PatternMatcher:
+
+    def __init__(self, patterns):
+
+        self.patterns  = sorted(set(pattern.lower() for pattern in patterns), key=len, reverse=True)
+        self.any_regex = re.compile(get_trie_regex(self.patterns))
+
+    # Get first pattern found in input name, if any
+    def search(self, name):
+
+        if STATS is not None:
+            STATS.count('pattern_matches')
+
+        match = self.any_regex.search(name.lower())
+        if match:
+            return match.group(0)
+        else:
+            return None
+
+    # Check all patterns are found in input name, stopping on the first missing pattern,
+    # which is what a few "without" patterns are mostly about
+    def matches_all(self, name):
+
+        if STATS is not None:
+            STATS.count('pattern_matches')
+
+        lowered_name = name.lower()
+
+        for pattern in self.patterns:
+            if pattern not in lowered_name:
+                return False
+
+        return True
+
+
+def check_and_get_preferences_list(list_string, is_verbose=True):
+
+    preferences_list = []
+
+    for preference in list_string.split(","):
+        preference = preference.strip().lower()
+        if preference:
+            if is_verbose:
+                log(2, "Adding preference: '" + preference + "'")
+            preferences_list.append(preference)
+
+    if not preferences_list:
+        log(0, "ERROR: badly formatted input list of regions/languages; shall be like \"Europe,USA,World,Japan\"")
+
+    return preferences_list
+
+
+def check_and_get_bioses_list(list_string, is_verbose=True):
+
+    bios_list = []
+
+    matches = re.findall(r"\w+", list_string)
+
+    if not matches:
+        log(0, "ERROR: badly formatted input list of patterns; shall be like \"BIOS1 BIOS2\"")
+    else:
+        for match in matches:
+            pattern = match.replace(" ", "").lower()
+            if is_verbose:
+                log(2, "Adding pattern: '" + pattern + "'")
+            bios_list.append(pattern)
+
+    return bios_list
+
+
+def check_and_get_year(year_string):
+
+    try:
+        return int(year_string)
+    except ValueError:
+        log(0, "ERROR: badl input year (\"" + year_string + "\"); please use an integer")
+        return None
+
+
+# Compact record of a game found in the .dat file, only holding what cleaning needs
+class DatGame:
+
+    __slots__ = ('name', 'cloneof', 'romof', 'sampleof', 'isbios', 'year',
+                 'description', 'manufacturer', 'comment', 'has_samples', 'roms')
+
+    def __init__(self, name, cloneof=None, romof=None, sampleof=None, isbios=False, year=None,
+                 description=None, manufacturer=None, comment=None, has_samples=False, roms=None):
+
+        self.name         = name
+        self.cloneof      = cloneof
+        self.romof        = romof
+        self.sampleof     = sampleof
+        self.isbios       = isbios
+        self.year         = year
+        self.description  = description
+        self.manufacturer = manufacturer
+        self.comment      = comment
+        self.has_samples  = has_samples
+        # Only loaded for archives audit: (name, size, CRC32, merged name) of each dumped ROM,
+        # merged name being set for ROMs of a clone also found in its parent
+        self.roms         = roms
+
+    def to_row(self):
+
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    @classmethod
+    def from_node(cls, node, with_roms=False):
+
+        if with_roms:
+            roms = tuple((rom.attrib.get("name"), int(rom.attrib.get("size", -1)), int(rom.attrib.get("crc"), 16),
+                          rom.attrib.get("merge"))
+                         for rom in node.findall("rom")
+                         if rom.attrib.get("crc") and rom.attrib.get("status") != "nodump")
+        else:
+            roms = None
+
+        return cls(node.attrib.get("name"),
+                   cloneof=node.attrib.get("cloneof"),
+                   romof=node.attrib.get("romof"),
+                   sampleof=node.attrib.get("sampleof"),
+                   isbios=bool(node.attrib.get("isbios")),
+                   year=node.findtext("year"),
+                   description=node.findtext("description"),
+                   manufacturer=node.findtext("manufacturer"),
+                   comment=node.findtext("comment"),
+                   has_samples=node.find("sample") is not None,
+                   roms=roms)
+
+
+# Games found in a .dat file, whatever their store, which provides get_game()
+class DatStore:
+
+    def get(self, name):
+
+        if STATS is not None:
+            STATS.count('dat_lookups')
+
+        return self.get_game(name)
+
+    # Get root ROM of a game, following its cloneof, romof or sampleof parents, along with
+    # True if this root is a BIOS; roots are memoized for all games met along the way
+    def get_root(self, name):
+
+        if STATS is not None:
+            STATS.count('dat_lookups')
+
+        if name in self.roots:
+            return self.roots[name]
+
+        chain   = []
+        current = name
+
+        while True:
+            if current in self.roots:
+                root = self.roots[current]
+                break
+            game = self.get_game(current)
+            if not game:
+                if chain:
+                    log(2, "WARNING: " + chain[-1] + " parent ROM not found in .dat file: " + current)
+                root = (None, False)
+                break
+            if current in chain:
+                log(1, "WARNING: cyclic parent ROMs in .dat file: " + " -> ".join(chain[chain.index(current):] + [current]))
+                root = (None, False)
+                break
+            chain.append(current)
+            parent = game.cloneof or game.romof or game.sampleof
+            if not parent:
+                if game.isbios:
+                    root = (game.name, True)
+                else:
+                    root = (game.name, None)
+                break
+            current = parent
+
+        for chained_name in chain:
+            self.roots[chained_name] = root
+
+        return root
+
+    # Queries below get games of the whole .dat file, or only games of input names when
+    # set, which stores may take as a mere hint
+
+    # Get roots of games, as got by get_root(), by game name; they are all resolved in a
+    # single pass, so that callers then do a single lookup per ROM
+    def resolve_roots(self, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        for game in self.iter_games(names):
+            self.get_root(game.name)
+
+        return self.roots
+
+    # Get years of games older than input year, by game name
+    def get_older_than(self, year, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        return {game.name: game.year for game in self.iter_games(names)
+                if game.year is not None and get_year_integer(game.year) < year}
+
+    # Get names of BIOS games
+    def get_bioses(self, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        return [game.name for game in self.iter_games(names) if game.isbios]
+
+    # Get names of games having sound samples
+    def get_with_samples(self, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        return [game.name for game in self.iter_games(names) if game.has_samples]
+
+    # Get values of input field (description, manufacturer or comment) matching any of the
+    # patterns of input matcher, by game name; a value shared by many games is matched once
+    def get_matching(self, field, matcher, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        matches        = {}
+        matching_games = {}
+
+        for game in self.iter_games(names):
+            value = getattr(game, field)
+            if value is not None:
+                if value not in matches:
+                    matches[value] = matcher.search(value) is not None
+                if matches[value]:
+                    matching_games[game.name] = value
+
+        return matching_games
+
+    # Get names of games matching input expression, evaluated in a single pass over games;
+    # results are kept, so that a same expression is only evaluated once per game of .dat file
+    def get_where(self, expression, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        results = self.where_results.setdefault(expression.expression_string, {})
+
+        for game in self.iter_games(names):
+            if game.name not in results:
+                results[game.name] = expression.matches(game)
+
+        return set(name for name, is_matching in results.items() if is_matching)
+
+    def add_rows(self, rows):
+
+        for row in rows:
+            self.add(DatGame(*row))
+
+        return self
+
+
+# Games found in a .dat file, indexed by name
+class DatIndex(DatStore):
+
+    def __init__(self, with_roms=False):
+
+        self.games         = {}
+        self.roots         = {}
+        self.where_results = {}
+        self.with_roms     = with_roms
+
+    def __len__(self):
+
+        return len(self.games)
+
+    def __contains__(self, name):
+
+        return name in self.games
+
+    def add(self, game):
+
+        # Like the former XPath lookups, only the first game with a given name is considered
+        if game.name not in self.games:
+            self.games[game.name] = game
+
+    def get_game(self, name):
+
+        return self.games.get(name)
+
+    def iter_games(self, names=None):
+
+        if names is None:
+            return iter(self.games.values())
+
+        return (self.games[name] for name in names if name in self.games)
+
+    def to_rows(self):
+
+        return [game.to_row() for game in self.games.values()]
+
+
+def get_year_integer(year_string):
+
+    try:
+        return int(year_string)
+    except ValueError:
+        return UNKNOWN_YEAR
+
+
+# Flags of games in a DatColumns store
+DAT_IS_BIOS     = 1
+DAT_HAS_SAMPLES = 2
+
+# Fields of games having few distinct values, e.g. parent names or manufacturers, which are
+# stored once each in a DatColumns store, games only holding the integer id of their value
+DAT_INTERNED_FIELDS = ('cloneof', 'romof', 'sampleof', 'manufacturer', 'comment')
+
+# Year of games having no year in a DatColumns store
+NO_YEAR = -1
+
+
+# Games found in a .dat file, stored as columns of arrays rather than as a record per game,
+# which takes a few bytes per game, and lets queries over all games, e.g. on their year, run
+# as vectorized operations, with NumPy when available; archives audit ROMs are not stored
+class DatColumns(DatStore):
+
+    def __init__(self):
+
+        self.with_roms    = False
+        self.names        = []
+        self.indexes      = {}
+        self.descriptions = []
+        self.years        = array.array('i')
+        # Year strings which are no plain integer, e.g. "198?", by game index
+        self.year_strings = {}
+        self.flags        = array.array('B')
+        self.ids          = {field: array.array('i') for field in DAT_INTERNED_FIELDS}
+        self.values       = {field: [] for field in DAT_INTERNED_FIELDS}
+        self.value_ids    = {field: {} for field in DAT_INTERNED_FIELDS}
+        self.roots        = {}
+        self.where_results = {}
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def __contains__(self, name):
+
+        return name in self.indexes
+
+    def add(self, game):
+
+        # Like the former XPath lookups, only the first game with a given name is considered
+        if game.name in self.indexes:
+            return
+
+        index = len(self.names)
+        self.indexes[game.name] = index
+        self.names.append(game.name)
+        self.descriptions.append(game.description)
+
+        if game.year is None:
+            self.years.append(NO_YEAR)
+        else:
+            year = get_year_integer(game.year)
+            if str(year) != game.year or not UNKNOWN_YEAR <= year < 2 ** 31:
+                year = min(max(year, UNKNOWN_YEAR), 2 ** 31 - 1)
+                self.year_strings[index] = game.year
+            self.years.append(year)
+
+        self.flags.append((DAT_IS_BIOS if game.isbios else 0) | (DAT_HAS_SAMPLES if game.has_samples else 0))
+
+        for field in DAT_INTERNED_FIELDS:
+            value = getattr(game, field)
+            if value is None:
+                self.ids[field].append(-1)
+            else:
+                value_ids = self.value_ids[field]
+                if value not in value_ids:
+                    value_ids[value] = len(self.values[field])
+                    self.values[field].append(value)
+                self.ids[field].append(value_ids[value])
+
+    # Get a record of a game, built from its columns
+    def get_game(self, name):
+
+        index = self.indexes.get(name)
+        if index is None:
+            return None
+
+        flags = self.flags[index]
+
+        return DatGame(name,
+                       cloneof=self.get_value('cloneof', index),
+                       romof=self.get_value('romof', index),
+                       sampleof=self.get_value('sampleof', index),
+                       isbios=bool(flags & DAT_IS_BIOS),
+                       year=self.get_year_string(index),
+                       description=self.descriptions[index],
+                       manufacturer=self.get_value('manufacturer', index),
+                       comment=self.get_value('comment', index),
+                       has_samples=bool(flags & DAT_HAS_SAMPLES))
+
+    def iter_games(self, names=None):
+
+        if names is None:
+            names = self.names
+
+        return (self.get_game(name) for name in names if name in self.indexes)
+
+    def get_value(self, field, index):
+
+        value_id = self.ids[field][index]
+        if value_id == -1:
+            return None
+
+        return self.values[field][value_id]
+
+    def get_year_string(self, index):
+
+        year = self.years[index]
+        if year == NO_YEAR:
+            return None
+
+        return self.year_strings.get(index, str(year))
+
+    # Get indexes of games having input flag
+    def select_flagged(self, flag):
+
+        if numpy:
+            return numpy.flatnonzero(numpy.frombuffer(self.flags, dtype=numpy.uint8) & flag).tolist()
+
+        return [index for index, flags in enumerate(self.flags) if flags & flag]
+
+    # Get indexes of games whose value of input field is one of input values ids
+    def select_values(self, field, value_ids):
+
+        field_ids = self.ids[field]
+
+        if numpy:
+            return numpy.flatnonzero(numpy.isin(numpy.frombuffer(field_ids, dtype=numpy.intc), list(value_ids))).tolist()
+
+        return [index for index, value_id in enumerate(field_ids) if value_id in value_ids]
+
+    def get_older_than(self, year, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        if numpy:
+            years   = numpy.frombuffer(self.years, dtype=numpy.intc)
+            indexes = numpy.flatnonzero((years != NO_YEAR) & (years < year)).tolist()
+        else:
+            indexes = [index for index, game_year in enumerate(self.years) if game_year != NO_YEAR and game_year < year]
+
+        return {self.names[index]: self.get_year_string(index) for index in indexes}
+
+    def get_bioses(self, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        return [self.names[index] for index in self.select_flagged(DAT_IS_BIOS)]
+
+    def get_with_samples(self, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        return [self.names[index] for index in self.select_flagged(DAT_HAS_SAMPLES)]
+
+    def get_matching(self, field, matcher, names=None):
+
+        if STATS is not None:
+            STATS.count('dat_queries')
+
+        # Descriptions are mostly unique, so they are matched game by game
+        if field == 'description':
+            matches        = {}
+            matching_games = {}
+            for index, description in enumerate(self.descriptions):
+                if description is not None:
+                    if description not in matches:
+                        matches[description] = matcher.search(description) is not None
+                    if matches[description]:
+                        matching_games[self.names[index]] = description
+            return matching_games
+
+        # Other values are matched once each, then games having a matching one are selected
+        values       = self.values[field]
+        matching_ids = set(value_id for value_id, value in enumerate(values) if matcher.search(value))
+
+        if not matching_ids:
+            return {}
+
+        return {self.names[index]: values[self.ids[field][index]] for index in self.select_values(field, matching_ids)}
+
+    def to_rows(self):
+
+        return [self.get_game(name).to_row() for name in self.names]
+
+
+# Start tag of a game in a .dat file, and its name attribute
+DAT_GAME_START_REGEX = re.compile(rb"<(game|machine)\s[^>]*>")
+DAT_GAME_NAME_REGEX  = re.compile(rb"\sname\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+# Encoding declared by the XML prolog of a .dat file, UTF-8 being the default
+DAT_ENCODING_REGEX = re.compile(rb"<\?xml\s[^>]*?encoding\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+def get_dat_encoding(data):
+
+    match = DAT_ENCODING_REGEX.match(data[:1024].lstrip(b'\xef\xbb\xbf \t\r\n'))
+    if not match:
+        return 'utf-8'
+
+    encoding = (match.group(1) if match.group(1) is not None else match.group(2)).decode('ascii', 'replace')
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        log(1, "WARNING: unknown encoding of .dat file, UTF-8 is used instead: " + encoding)
+        return 'utf-8'
+
+
+# Games found in a .dat file, only located by a single scan of the memory-mapped file, each
+# game being parsed from its own XML fragment when first looked up; it suits runs on a few
+# ROMs against a large .dat file, which is then never parsed as a whole
+class LazyDatIndex(DatStore):
+
+    def __init__(self, path_to_dat_file, with_roms=False):
+
+        self.path_to_dat_file = path_to_dat_file
+        self.with_roms        = with_roms
+        self.indexes          = {}
+        self.starts           = array.array('q')
+        self.ends             = array.array('q')
+        self.games            = {}
+        self.roots            = {}
+        self.where_results    = {}
+
+        with open(path_to_dat_file, 'rb') as file:
+            try:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped
+                self.data = b''
+
+        # Game fragments have no XML prolog, so that they are decoded as declared by the file one
+        self.encoding = get_dat_encoding(self.data)
+
+    def __len__(self):
+
+        return len(self.indexes)
+
+    def __contains__(self, name):
+
+        return name in self.indexes
+
+    def add_offsets(self, name, start, end):
+
+        # Like the former XPath lookups, only the first game with a given name is considered
+        if name not in self.indexes:
+            self.indexes[name] = len(self.starts)
+            self.starts.append(start)
+            self.ends.append(end)
+
+    # Locate games, skipping their content, which is never scanned but for their end tag
+    def scan(self):
+
+        data     = self.data
+        position = 0
+
+        while True:
+            match = DAT_GAME_START_REGEX.search(data, position)
+            if not match:
+                break
+            start_tag = match.group(0)
+            if start_tag.endswith(b'/>'):
+                end = match.end()
+            else:
+                end_tag = b'</' + match.group(1) + b'>'
+                end     = data.find(end_tag, match.end())
+                if end == -1:
+                    log(1, "WARNING: unterminated game in .dat file at offset " + str(match.start()))
+                    break
+                end += len(end_tag)
+            name_match = DAT_GAME_NAME_REGEX.search(start_tag)
+            if name_match:
+                name = (name_match.group(1) if name_match.group(1) is not None else name_match.group(2)).decode(self.encoding, 'replace')
+                if '&' in name:
+                    name = html.unescape(name)
+                self.add_offsets(name, match.start(), end)
+            position = end
+
+        return self
+
+    def get_offsets(self):
+
+        return (list(self.indexes), self.starts, self.ends)
+
+    def set_offsets(self, names, starts, ends):
+
+        self.indexes = {name: index for index, name in enumerate(names)}
+        self.starts  = starts
+        self.ends    = ends
+
+        return self
+
+    # Get a record of a game, parsed from its XML fragment once
+    def get_game(self, name):
+
+        game = self.games.get(name)
+
+        if game is None and name in self.indexes:
+            index = self.indexes[name]
+            try:
+                node = ElementTree.fromstring(self.data[self.starts[index]:self.ends[index]],
+                                              parser=ElementTree.XMLParser(encoding=self.encoding))
+            except ElementTree.ParseError as error:
+                log(1, "WARNING: could not parse " + name + " game in .dat file: " + str(error))
+                return None
+            game = DatGame.from_node(node, self.with_roms)
+            self.games[name] = game
+            if STATS is not None:
+                STATS.count('dat_games_parsed')
+
+        return game
+
+    # Games which could not be parsed are skipped
+    def iter_games(self, names=None):
+
+        if names is None:
+            names = self.indexes
+
+        games = (self.get_game(name) for name in names if name in self.indexes)
+
+        return (game for game in games if game is not None)
+
+
+# Fields of games which expressions can test, along with the kind of their values
+DAT_EXPRESSION_FIELDS = {'name': 'text', 'description': 'text', 'manufacturer': 'text', 'comment': 'text',
+                         'cloneof': 'text', 'romof': 'text', 'sampleof': 'text', 'year': 'year',
+                         'isbios': 'flag', 'has_samples': 'flag'}
+
+# Comparison operators of expressions; ~ and !~ look for a substring, ignoring case
+DAT_EXPRESSION_OPERATORS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le,
+                            '>': operator.gt, '>=': operator.ge, '~': None, '!~': None}
+
+DAT_EXPRESSION_TOKEN_REGEX = re.compile(r"\s*(?:(\d+)|'([^']*)'|\"([^\"]*)\"|([A-Za-z_]\w*)|(!~|==|!=|<=|>=|~|<|>|\(|\)))")
+
+
+# Expression over fields of games, e.g. "year < 1990 and manufacturer ~ 'bootleg' and not
+# isbios", compiled once into a predicate on games; with "not", "and" and "or" from highest
+# to lowest priority. Games with no year never match comparisons of their year with integers,
+# while missing text fields are deemed empty
+class DatExpression:
+
+    def __init__(self, expression_string):
+
+        self.expression_string = expression_string
+        self.tokens            = DatExpression.tokenize(expression_string)
+        self.position          = 0
+        self.predicate         = self.parse_or()
+
+        if self.position < len(self.tokens):
+            raise ValueError("unexpected " + self.describe(self.tokens[self.position]))
+
+    def matches(self, game):
+
+        return self.predicate(game)
+
+    # Get (kind, value) tokens of input expression, kind being 'integer', 'text', 'keyword',
+    # 'field' or 'operator'
+    @staticmethod
+    def tokenize(expression_string):
+
+        tokens   = []
+        position = 0
+        string   = expression_string.rstrip()
+
+        while position < len(string):
+            match = DAT_EXPRESSION_TOKEN_REGEX.match(string, position)
+            if not match:
+                raise ValueError("unexpected character at position " + str(position + 1) + ": " +
+                                 string[position:].lstrip()[0])
+            integer, single_quoted, double_quoted, word, operator_string = match.groups()
+            if integer is not None:
+                tokens.append(('integer', int(integer)))
+            elif single_quoted is not None:
+                tokens.append(('text', single_quoted))
+            elif double_quoted is not None:
+                tokens.append(('text', double_quoted))
+            elif word is not None:
+                if word.lower() in ('and', 'or', 'not'):
+                    tokens.append(('keyword', word.lower()))
+                else:
+                    tokens.append(('field', word.lower()))
+            else:
+                tokens.append(('operator', operator_string))
+            position = match.end()
+
+        return tokens
+
+    @staticmethod
+    def describe(token):
+
+        if token is None:
+            return "end of expression"
+        elif token[0] == 'text':
+            return "'" + token[1] + "'"
+        else:
+            return str(token[1])
+
+    def peek(self):
+
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+
+        return None
+
+    def next(self):
+
+        token = self.peek()
+        self.position += 1
+
+        return token
+
+    def parse_or(self):
+
+        predicate = self.parse_and()
+
+        while self.peek() == ('keyword', 'or'):
+            self.next()
+            predicate = DatExpression.get_or(predicate, self.parse_and())
+
+        return predicate
+
+    def parse_and(self):
+
+        predicate = self.parse_not()
+
+        while self.peek() == ('keyword', 'and'):
+            self.next()
+            predicate = DatExpression.get_and(predicate, self.parse_not())
+
+        return predicate
+
+    def parse_not(self):
+
+        token = self.next()
+
+        if token == ('keyword', 'not'):
+            operand = self.parse_not()
+            return lambda game: not operand(game)
+
+        if token == ('operator', '('):
+            predicate = self.parse_or()
+            token     = self.next()
+            if token != ('operator', ')'):
+                raise ValueError("expected ')' instead of " + self.describe(token))
+            return predicate
+
+        if token is not None and token[0] == 'field':
+            return self.parse_comparison(token[1])
+
+        raise ValueError("expected a field, 'not' or '(' instead of " + self.describe(token))
+
+    def parse_comparison(self, field):
+
+        if field not in DAT_EXPRESSION_FIELDS:
+            raise ValueError("unknown field '" + field + "'; please use one of: " + ", ".join(DAT_EXPRESSION_FIELDS))
+
+        kind  = DAT_EXPRESSION_FIELDS[field]
+        token = self.peek()
+
+        # A field alone tests it is set, e.g. "cloneof", or true, e.g. "isbios"
+        if token is None or token[0] != 'operator' or token[1] not in DAT_EXPRESSION_OPERATORS:
+            return lambda game: bool(getattr(game, field))
+
+        operator_string = self.next()[1]
+        value_token     = self.next()
+
+        if value_token is None or value_token[0] not in ('integer', 'text'):
+            raise ValueError("expected a value after " + operator_string + " instead of " + self.describe(value_token))
+        if kind == 'flag':
+            raise ValueError(field + " takes no value; please use '" + field + "' or 'not " + field + "'")
+
+        value = value_token[1]
+
+        if kind == 'year' and value_token[0] == 'integer' and operator_string not in ('~', '!~'):
+            compare = DAT_EXPRESSION_OPERATORS[operator_string]
+            return lambda game: game.year is not None and compare(get_year_integer(game.year), value)
+
+        if operator_string in ('~', '!~'):
+            return DatExpression.get_contains(field, str(value).lower(), operator_string == '~')
+
+        if operator_string in ('==', '!='):
+            compare = DAT_EXPRESSION_OPERATORS[operator_string]
+            lowered = str(value).lower()
+            return lambda game: compare((getattr(game, field) or '').lower(), lowered)
+
+        raise ValueError(operator_string + " only compares year with an integer")
+
+    # Look for a substring in a field, matching each distinct value of the field once
+    @staticmethod
+    def get_contains(field, lowered_substring, is_expected):
+
+        matches = {}
+
+        def contains(game):
+            value = getattr(game, field) or ''
+            if value not in matches:
+                matches[value] = (lowered_substring in value.lower()) == is_expected
+            return matches[value]
+
+        return contains
+
+    @staticmethod
+    def get_and(left, right):
+
+        return lambda game: left(game) and right(game)
+
+    @staticmethod
+    def get_or(left, right):
+
+        return lambda game: left(game) or right(game)
+
+
+# .dat files indexes, built once per run
+DAT_INDEXES = {}
+
+
+# .dat file elements describing a game; recent MAME -listxml outputs use "machine"
+DAT_GAME_TAGS = ('game', 'machine')
+
+
+def iter_dat_games(path_to_dat_file, with_roms=False):
+
+    # Stream the .dat file rather than building a whole tree, so that memory only grows
+    # with the count of games, not with the size of the XML (ROMs, chips, inputs, etc.)
+    with open(path_to_dat_file, 'rb') as file:
+        context = iter(ElementTree.iterparse(file, events=('start', 'end')))
+        event, root = next(context)
+        for event, node in context:
+            if event == 'end' and node.tag in DAT_GAME_TAGS:
+                yield DatGame.from_node(node, with_roms)
+                # Drop the game element, and any sibling already read, once recorded
+                node.clear()
+                root.clear()
+
+
+def load_lazy_dat_index(path_to_dat_file, with_roms=False):
+
+    dat_index = LazyDatIndex(path_to_dat_file, with_roms)
+    offsets   = None
+
+    if USE_DAT_CACHE and not REBUILD_DAT_CACHE:
+        offsets = load_dat_cache(path_to_dat_file, 'offsets')
+
+    if offsets is not None:
+        dat_index.set_offsets(*offsets)
+    else:
+        if USE_DAT_CACHE:
+            identity = get_dat_identity(path_to_dat_file)
+        dat_index.scan()
+        if USE_DAT_CACHE:
+            save_dat_cache(path_to_dat_file, 'offsets', dat_index.get_offsets(), identity)
+
+    log(2, "Located " + str(len(dat_index)) + " games in: " + path_to_dat_file)
+
+    return dat_index
+
+
+# Get an empty store of .dat file games; archives audit needs ROMs of games, which are only
+# held by an index of game records
+def new_dat_index(with_roms=False):
+
+    if DAT_STORE == 'columns' and not with_roms:
+        return DatColumns()
+
+    return DatIndex(with_roms)
+
+
+def load_dat_index(path_to_dat_file, with_roms=False):
+
+    dat_index = new_dat_index(with_roms)
+
+    for game in iter_dat_games(path_to_dat_file, with_roms):
+        dat_index.add(game)
+
+    log(2, "Indexed " + str(len(dat_index)) + " games from: " + path_to_dat_file)
+
+    if STATS is not None:
+        STATS.count('dat_games_parsed', len(dat_index))
+
+    return dat_index
+
+
+def get_cache_dir():
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(cache_home, 'pyrsc')
+
+
+def get_file_sha1(path_to_file, max_size=None):
+
+    sha1 = hashlib.sha1()
+
+    with open(path_to_file, 'rb') as file:
+        if max_size is not None:
+            sha1.update(file.read(max_size))
+        else:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def get_file_digests(path_to_file):
+
+    crc32 = 0
+    md5   = hashlib.md5()
+    sha1  = hashlib.sha1()
+
+    with open(path_to_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            crc32 = zlib.crc32(chunk, crc32)
+            md5.update(chunk)
+            sha1.update(chunk)
+
+    return {'crc32': '%08x' % crc32, 'md5': md5.hexdigest(), 'sha1': sha1.hexdigest()}
+
+
+# Digests of files, stored in a SQLite database and keyed by file identity, i.e. device
+# and inode, along with size and modification time, so that a changed file is read again
+class DigestCache:
+
+    DIGESTS = ('partial_sha1', 'crc32', 'md5', 'sha1')
+
+    def __init__(self, path_to_cache_file):
+
+        self.connection = None
+
+        if not path_to_cache_file or not sqlite3:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(path_to_cache_file), exist_ok=True)
+            self.connection = sqlite3.connect(path_to_cache_file)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS digests ("
+                                    "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                                    "partial_sha1 TEXT, crc32 TEXT, md5 TEXT, sha1 TEXT, "
+                                    "PRIMARY KEY (dev, ino))")
+        except (OSError, sqlite3.Error) as error:
+            log(1, "WARNING: not using files digests cache " + path_to_cache_file + ": " + str(error))
+            self.connection = None
+
+    # Get digests known for a file, from its stat result; any digest may be missing
+    def get(self, stat):
+
+        if not self.connection:
+            return {}
+
+        row = self.connection.execute("SELECT size, mtime_ns, partial_sha1, crc32, md5, sha1 FROM digests "
+                                      "WHERE dev = ? AND ino = ?", (stat.st_dev, stat.st_ino)).fetchone()
+        if not row or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return {}
+
+        return {digest: value for digest, value in zip(self.DIGESTS, row[2:]) if value is not None}
+
+    # Save all digests known for a file, replacing any outdated ones
+    def put(self, stat, digests):
+
+        if not self.connection:
+            return
+
+        self.connection.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) +
+                                tuple(digests.get(digest) for digest in self.DIGESTS))
+
+    def close(self):
+
+        if self.connection:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+def open_digest_cache():
+
+    if USE_DIGEST_CACHE:
+        return DigestCache(os.path.join(get_cache_dir(), 'digests.sqlite'))
+    else:
+        return DigestCache(None)
+
+
+def get_dat_identity(path_to_dat_file):
+
+    stat = os.stat(path_to_dat_file)
+
+    return {'version':  DAT_CACHE_VERSION,
+            'path':     os.path.abspath(path_to_dat_file),
+            'size':     stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1':     get_file_sha1(path_to_dat_file)}
+
+
+def get_dat_cache_path(path_to_dat_file, kind):
+
+    path_hash = hashlib.sha1(os.path.abspath(path_to_dat_file).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    return os.path.join(get_cache_dir(), path_hash + '.' + kind + '.cache')
+
+
+def save_dat_cache(path_to_dat_file, kind, data, identity):
+
+    cache_path = get_dat_cache_path(path_to_dat_file, kind)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write a temporary file first, so that no reader ever sees a partial cache file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(identity, file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(data, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+        log(2, "Saved .dat cache file: " + cache_path)
+    except OSError as error:
+        log(1, "WARNING: could not save .dat cache file " + cache_path + ": " + str(error))
+
+
+def load_dat_cache(path_to_dat_file, kind):
+
+    cache_path = get_dat_cache_path(path_to_dat_file, kind)
+
+    try:
+        stat = os.stat(path_to_dat_file)
+        with open(cache_path, 'rb') as file:
+            identity = pickle.load(file)
+            if identity['version'] != DAT_CACHE_VERSION or \
+               identity['path'] != os.path.abspath(path_to_dat_file) or \
+               identity['size'] != stat.st_size:
+                log(2, "Outdated .dat cache file: " + cache_path)
+                return None
+            is_touched = identity['mtime_ns'] != stat.st_mtime_ns
+            # A touched .dat file, e.g. copied again, may still be the same: check its content
+            if is_touched and identity['sha1'] != get_file_sha1(path_to_dat_file):
+                log(2, "Outdated .dat cache file: " + cache_path)
+                return None
+            data = pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as error:
+        log(1, "WARNING: ignoring unreadable .dat cache file " + cache_path + ": " + repr(error))
+        return None
+
+    if is_touched:
+        identity['mtime_ns'] = stat.st_mtime_ns
+        save_dat_cache(path_to_dat_file, kind, data, identity)
+
+    log(2, "Loaded .dat cache file: " + cache_path)
+
+    return data
+
+
+def get_dat_index(path_to_dat_file, with_roms=False):
+
+    # An index holding ROMs of games also serves requests not needing them
+    dat_index = DAT_INDEXES.get(path_to_dat_file)
+
+    if dat_index is None or (with_roms and not dat_index.with_roms):
+        dat_index = None
+        if with_roms:
+            kind = 'index-roms'
+        else:
+            kind = 'index'
+        with phase('load_dat'):
+            if DAT_STORE == 'lazy':
+                dat_index = load_lazy_dat_index(path_to_dat_file, with_roms)
+            elif USE_DAT_CACHE and not REBUILD_DAT_CACHE:
+                rows = load_dat_cache(path_to_dat_file, kind)
+                if rows is not None:
+                    dat_index = new_dat_index(with_roms).add_rows(rows)
+                    if STATS is not None:
+                        STATS.count('dat_games_from_cache', len(dat_index))
+            if dat_index is None:
+                if USE_DAT_CACHE:
+                    identity = get_dat_identity(path_to_dat_file)
+                dat_index = load_dat_index(path_to_dat_file, with_roms)
+                if USE_DAT_CACHE:
+                    save_dat_cache(path_to_dat_file, kind, dat_index.to_rows(), identity)
+        DAT_INDEXES[path_to_dat_file] = dat_index
+
+    return dat_index
+
+
+# Parts of a file name, parsed once: its name without extension, used to look games up in
+# .dat files, its title, used to group variants of a same ROM, and what its tags tell
+class RomName:
+
+    __slots__ = ('stem', 'extension', 'lowered_title', 'group_key', 'variant', 'tags', 'flags',
+                 'regions', 'languages', 'revision', 'other_tags', 'is_pal')
+
+    def __init__(self, name):
+
+        self.stem, self.extension = os.path.splitext(name)
+
+        # Title is what comes before the first tag or flag
+        tags_start = len(self.stem)
+        for character in "([":
+            index = self.stem.find(character)
+            if index != -1 and index < tags_start:
+                tags_start = index
+        self.lowered_title = self.stem[:tags_start].strip().lower()
+
+        # Variants of a ROM share what comes before their first tag, which is the variant;
+        # untagged names keep their extension, so that e.g. a ROM and its image moved up by
+        # --make-flat are not taken as variants of each other
+        head, separator, tail = name.partition("(")
+        if separator:
+            self.group_key = head.strip().lower()
+            self.variant   = tail.split("(")[0].strip().lower() if ")" in tail else None
+        else:
+            self.group_key = name.strip().lower()
+            self.variant   = None
+
+        # Same tags are found in many names, e.g. " (Europe) (Rev 1)", so parse them only once
+        tags_string = self.stem[tags_start:]
+        if tags_string not in ROM_NAME_TAGS_CACHE:
+            ROM_NAME_TAGS_CACHE[tags_string] = RomName.parse_tags(tags_string)
+
+        self.tags, self.flags, self.regions, self.languages, self.revision, self.other_tags, self.is_pal = \
+            ROM_NAME_TAGS_CACHE[tags_string]
+
+    @staticmethod
+    def parse_tags(tags_string):
+
+        tags      = []
+        flags     = []
+        regions    = []
+        languages  = []
+        revision   = None
+        # Lowered tags telling neither a region, a language nor a revision, e.g. "disc 2"
+        other_tags = []
+
+        for tag, flag in ROM_NAME_TAG_REGEX.findall(tags_string):
+            if flag:
+                flags.append(flag)
+                continue
+            tags.append(tag)
+            items = ROM_NAME_TAG_SEPARATOR_REGEX.split(tag.strip())
+            if all(item in REGIONS for item in items):
+                regions += [REGIONS[item] for item in items]
+            elif tag.isupper() and len(tag) <= 4 and all(code in GOODTOOLS_REGIONS for code in tag):
+                regions += [GOODTOOLS_REGIONS[code] for code in tag]
+            elif all(ROM_NAME_LANGUAGE_REGEX.match(item) for item in items):
+                languages += [item.capitalize() for item in items]
+            else:
+                matches = ROM_NAME_REVISION_REGEX.match(tag.strip())
+                if matches and revision is None:
+                    revision = matches.group(1) or matches.group(2)
+                else:
+                    other_tags.append(tag.strip().lower())
+
+        return (tuple(tags), tuple(flags), tuple(regions), tuple(languages), revision, tuple(other_tags),
+                PAL_TAG_REGEX.search(tags_string) is not None)
+
+
+# Parsed tags of ROM names, by tags part of names
+ROM_NAME_TAGS_CACHE = {}
+
+
+# File found when scanning the ROMs directory
+class RomFile:
+
+    __slots__ = ('parent_dir', 'name', 'full_name', 'is_deleted', 'stat', 'rom_name')
+
+    def __init__(self, parent_dir, name, stat=None):
+
+        self.parent_dir = parent_dir
+        self.name       = name
+        self.full_name  = os.path.join(parent_dir, name)
+        self.is_deleted = False
+        self.stat       = stat
+        self.rom_name   = None
+
+    # Get parts of the file name, parsed on first use only, then shared by all stages
+    def get_rom_name(self):
+
+        if self.rom_name is None:
+            self.rom_name = RomName(self.name)
+
+        return self.rom_name
+
+    # Get stat result of the file, as got while scanning, so that it is not stat'ed again
+    def get_stat(self):
+
+        if self.stat is None:
+            self.stat = os.stat(self.full_name)
+
+        return self.stat
+
+
+# Delete input files of a single directory, relatively to an opened descriptor of it when
+# supported, to avoid resolving the whole path again for each file; get a list of (name, error)
+def delete_files_in_dir(dirname, names):
+
+    errors = []
+
+    dir_fd = None
+    if os.unlink in os.supports_dir_fd:
+        try:
+            dir_fd = os.open(dirname, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except OSError as error:
+            # Already gone directories are fine as well
+            if error.errno == errno.ENOENT:
+                return errors
+            raise
+
+    try:
+        for name in names:
+            try:
+                if dir_fd is None:
+                    os.unlink(os.path.join(dirname, name))
+                else:
+                    os.unlink(name, dir_fd=dir_fd)
+            except OSError as error:
+                # Already gone files are fine, e.g. when deleted by hand meanwhile
+                if error.errno != errno.ENOENT:
+                    errors.append((name, error))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+    return errors
+
+
+# List a single directory; get its subdirectories to be walked, any other subdirectory
+# name, and its files with their stat results, like os.walk does with no symlinks followed
+def scan_dir(dirname):
+
+    subdirs = []
+    files   = []
+
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+                continue
+            try:
+                stat = entry.stat()
+                # On Windows, stat results of directory entries have no inode number
+                if not stat.st_ino:
+                    stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            files.append(RomFile(dirname, entry.name, stat))
+
+    return subdirs, files
+
+
+# Delete input files, grouped by directory, in batches run by concurrent jobs; a failure
+# to delete a file is reported, but does not stop deleting other files
+def delete_files(names_by_dir):
+
+    batches = []
+    for dirname, names in names_by_dir.items():
+        for index in range(0, len(names), DELETE_BATCH_SIZE):
+            batches.append((dirname, names[index:index + DELETE_BATCH_SIZE]))
+
+    errors_count = 0
+    for batch, errors, error in run_jobs(lambda batch: delete_files_in_dir(*batch), batches):
+        dirname, names = batch
+        if error:
+            errors = [(name, error) for name in names]
+        for name, error in errors:
+            log(0, "ERROR: could not delete " + os.path.join(dirname, name) + ": " + str(error))
+            errors_count += 1
+
+    if errors_count:
+        log(0, "ERROR: " + str(errors_count) + " files could not be deleted")
+        if STATS is not None:
+            STATS.count('delete_errors', errors_count)
+
+    return errors_count
+
+
+# Content of the ROMs directory, scanned once and shared by all cleaning stages; a file
+# deleted by a stage is only marked as such, so that next stages do not see it anymore
+class Inventory:
+
+    def __init__(self, path_to_roms_dir):
+
+        self.path_to_roms_dir = path_to_roms_dir
+        self.dirs             = []
+        self.files            = []
+        self.deleted_dirs     = []
+
+    def scan(self):
+
+        # Directories of a same depth are listed concurrently, as each listing mostly waits for
+        # the file system, e.g. on network shares; the tree is then walked as os.walk does
+        scanned_dirs = {}
+        dirnames     = [self.path_to_roms_dir]
+        while dirnames:
+            next_dirnames = []
+            for dirname, result, error in run_jobs(scan_dir, dirnames):
+                if error:
+                    log(1, "WARNING: could not list directory " + dirname + ": " + str(error))
+                    continue
+                scanned_dirs[dirname] = result
+                next_dirnames += result[0]
+            dirnames = next_dirnames
+
+        dirnames = [self.path_to_roms_dir] if self.path_to_roms_dir in scanned_dirs else []
+        while dirnames:
+            dirname = dirnames.pop()
+            subdirs, files = scanned_dirs[dirname]
+            self.dirs.append(dirname)
+            self.files += files
+            dirnames += [subdir for subdir in reversed(subdirs) if subdir in scanned_dirs]
+
+        log(2, "Scanned " + str(len(self.files)) + " files in: " + self.path_to_roms_dir)
+
+        if STATS is not None:
+            STATS.count('dirs_scanned', len(self.dirs))
+            STATS.count('files_scanned', len(self.files))
+
+        return self
+
+    def get_files(self):
+
+        return [file for file in self.files if not file.is_deleted]
+
+    # Get names of ROMs of files, i.e. their names without extension, as games of .dat files
+    def get_rom_names(self):
+
+        return set(file.get_rom_name().stem for file in self.get_files())
+
+    def delete_file(self, file, details, reason=None):
+
+        global DELETED_FILES_COUNT
+
+        if IS_DRY_RUN:
+            log_action(1, 'would-delete', file.full_name, reason, "Would delete" + details)
+        else:
+            log_action(1, 'delete', file.full_name, reason, "Deleting" + details)
+        file.is_deleted = True
+        DELETED_FILES_COUNT += 1
+
+        if STATS is not None:
+            STATS.count('files_deleted')
+            if file.stat is not None:
+                STATS.count('bytes_reclaimed', file.stat.st_size)
+
+    def delete_dir(self, dirname, details, reason=None):
+
+        if IS_DRY_RUN:
+            log_action(1, 'would-delete-dir', dirname, reason, "Would delete" + details)
+        else:
+            log_action(1, 'delete-dir', dirname, reason, "Deleting" + details)
+        self.deleted_dirs.append(dirname)
+        prefix = os.path.join(dirname, '')
+        for file in self.files:
+            if file.parent_dir == dirname or file.parent_dir.startswith(prefix):
+                if STATS is not None and not file.is_deleted:
+                    STATS.count('files_deleted')
+                    if file.stat is not None:
+                        STATS.count('bytes_reclaimed', file.stat.st_size)
+                file.is_deleted = True
+
+        if STATS is not None:
+            STATS.count('dirs_deleted')
+
+    def is_deleted_dir(self, dirname):
+
+        for deleted_dir in self.deleted_dirs:
+            if dirname == deleted_dir or dirname.startswith(os.path.join(deleted_dir, '')):
+                return True
+
+        return False
 
+    # Get deleted files, but the ones of deleted directories, as directories are deleted as a whole
+    def get_deleted_files(self):
 
-def make_flat(path_to_roms_dir):
+        deleted_files = []
+        is_deleted_dir = {}
+        for file in self.files:
+            if file.is_deleted:
+                if file.parent_dir not in is_deleted_dir:
+                    is_deleted_dir[file.parent_dir] = self.is_deleted_dir(file.parent_dir)
+                if not is_deleted_dir[file.parent_dir]:
+                    deleted_files.append(file)
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        if os.path.basename(dirname) != os.path.basename(path_to_roms_dir):
-            for filename in filenames:
-                full_path = os.path.join(dirname, filename)
-                if os.path.isfile(os.path.join(path_to_roms_dir, filename)):
-                    log(1, "Will not move up file, as it already exists: " + full_path)
-                else:
-                    if IS_DRY_RUN:
-                        log(2, "Would move up file: " + full_path)
-                    else:
-                        log(2, "Moving up file: " + full_path)
-                        shutil.move(full_path, path_to_roms_dir)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        if os.path.basename(dirname) != os.path.basename(path_to_roms_dir):
-            if IS_DRY_RUN:
-                log(1, "Would remove directory: " + dirname)
-            else:
-                if os.listdir(dirname):
-                    log(1, "Will not remove directory, as it is not empty: " + dirname)
-                else:
-                    print("Removing directory: " + dirname)
-                    shutil.rmtree(dirname, ignore_errors=True)
+        return deleted_files
 
-    return 0
+    def apply_deletions(self):
 
+        if IS_DRY_RUN:
+            return 0
 
-def check_and_get_patterns_list(list_string):
+        names_by_dir = {}
+        for file in self.get_deleted_files():
+            names_by_dir.setdefault(file.parent_dir, []).append(file.name)
+        delete_files(names_by_dir)
 
-    list = []
+        for dirname in self.deleted_dirs:
+            shutil.rmtree(dirname, ignore_errors=True)
 
-    matches = re.search(r"^(\*[^\*]+\*\s*)+$", list_string)
-    if not matches:
-        log(0, "ERROR: badly formatted input list of patterns; shall be like \"*pattern1* *pattern2*\"")
-    else:
-        matches = re.findall(r"\*[^\*]+\*", list_string)
-        if not matches:
-            log(0, "ERROR: badly formatted input list of patterns; shall be like \"*pattern1* *pattern2*\"")
-        else:
-            for match in matches:
-                pattern = match.replace("*", "")
-                log(2, "Adding pattern: '" + pattern + "'")
-                list.append(pattern)
+        return 0
 
-    return list
 
+# Decisions of a dry run, i.e. files to be moved up and deleted, with their size and date
+# when decided, so that they can be applied later without scanning nor parsing anything
+class Plan:
 
-def check_and_get_bioses_list(list_string):
+    def __init__(self):
 
-    bios_list = []
+        self.moves        = []
+        self.removed_dirs = []
+        self.deletions    = []
+        self.deleted_dirs = []
+        self.destinations = {}
 
-    matches = re.findall(r"\w+", list_string)
+    @staticmethod
+    def get_entry(action, path, file=None):
 
-    if not matches:
-        log(0, "ERROR: badly formatted input list of patterns; shall be like \"BIOS1 BIOS2\"")
-    else:
-        for match in matches:
-            pattern = match.replace(" ", "").lower()
-            log(2, "Adding pattern: '" + pattern + "'")
-            bios_list.append(pattern)
+        entry = {'action': action, 'path': os.path.abspath(path)}
+        if file is not None:
+            try:
+                stat = file.get_stat()
+                entry['size']     = stat.st_size
+                entry['mtime_ns'] = stat.st_mtime_ns
+            except OSError:
+                entry['size']     = None
+                entry['mtime_ns'] = None
 
-    return bios_list
+        return entry
 
+    def add_move(self, file, destination):
 
-def get_bioses_from_roms_and_dat(path_to_roms_dir, path_to_dat_file):
+        entry = Plan.get_entry('move', file.full_name, file)
+        entry['destination'] = os.path.abspath(destination)
+        self.moves.append(entry)
+        self.destinations[entry['path']] = entry['destination']
 
-    bios_list = []
+    def add_removed_dir(self, dirname):
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
+        self.removed_dirs.append(Plan.get_entry('remove-dir', dirname))
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            nodes = tree.findall('.//game[@name="' + rom + '"]')
-            if len(nodes) != 0:
-                is_bios = nodes[0].attrib.get("isbios")
-                if is_bios:
-                    log(2, "Found BIOS ROM: " + rom)
-                    bios_list.append(rom)
+    # Add deletions of input inventory, at the place their files are moved to, if any
+    def add_deletions(self, inventory):
 
-    return bios_list
+        for file in inventory.get_deleted_files():
+            entry = Plan.get_entry('delete', file.full_name, file)
+            entry['path'] = self.destinations.get(entry['path'], entry['path'])
+            self.deletions.append(entry)
+        for dirname in inventory.deleted_dirs:
+            self.deleted_dirs.append(Plan.get_entry('delete-dir', dirname))
 
+    def write(self, path_to_plan_file):
 
-def get_parent_rom(tree, rom):
+        with open(path_to_plan_file, 'w', encoding='utf-8') as plan_file:
+            plan_file.write(json.dumps({'plan': 'pyrsc', 'version': PLAN_VERSION}) + '\n')
+            for entry in self.moves + self.removed_dirs + self.deletions + self.deleted_dirs:
+                plan_file.write(json.dumps(entry) + '\n')
 
-    nodes = tree.findall('.//game[@name="' + rom + '"]')
-    if len(nodes) == 0:
-        return None
-    else:
-        return nodes[0]
+        log(1, "\nWritten plan of " + str(len(self.moves)) + " moves and " +
+               str(len(self.deletions) + len(self.deleted_dirs)) + " deletions to: " + path_to_plan_file)
+
+        return 0
 
 
-def get_root_rom(tree, node):
+# Get entries of a plan whose file did not change since the plan was written; in dry-run
+# mode, files to be deleted once moved are checked at their current place
+def get_unchanged_entries(entries, moved_paths):
 
-    if not node:
-        return None, False
+    unchanged_entries = []
 
-    name = node.attrib.get("name")
-    clone_of = node.attrib.get("cloneof")
-    rom_of = node.attrib.get("romof")
-    sample_of = node.attrib.get("sampleof")
-    is_bios = node.attrib.get("isbios")
+    def get_stat(entry):
+        if IS_DRY_RUN:
+            return os.stat(moved_paths.get(entry['path'], entry['path']))
+        return os.stat(entry['path'])
 
-    if not clone_of and not rom_of and not sample_of:
-        if is_bios:
-            return name, True
+    for entry, stat, error in run_jobs(get_stat, entries):
+        if error:
+            log(1, "WARNING: skipping file not found anymore: " + entry['path'])
+        elif entry['size'] is not None and \
+             (stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']):
+            log(1, "WARNING: skipping file changed since plan was written: " + entry['path'])
         else:
-            return name, None
-    elif clone_of:
-        parent = get_parent_rom(tree, clone_of)
-        return get_root_rom(tree, parent)
-    elif rom_of:
-        parent = get_parent_rom(tree, rom_of)
-        return get_root_rom(tree, parent)
-    elif sample_of:
-        parent = get_parent_rom(tree, sample_of)
-        return get_root_rom(tree, parent)
+            unchanged_entries.append(entry)
 
+    return unchanged_entries
 
-def del_files_without(path_to_roms_dir, inclusion_list_string):
+
+def apply_plan(path_to_plan_file):
 
     global DELETED_FILES_COUNT
 
+    log(0, "\nApplying plan...\n")
+
+    entries = {'move': [], 'remove-dir': [], 'delete': [], 'delete-dir': []}
+    try:
+        with open(path_to_plan_file, encoding='utf-8') as plan_file:
+            header = json.loads(plan_file.readline() or 'null')
+            if not isinstance(header, dict) or header.get('plan') != 'pyrsc' or header.get('version') != PLAN_VERSION:
+                log(0, "ERROR: " + path_to_plan_file + " is not a plan file of this pyrsc version")
+                return 2
+            for line in plan_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry['action']].append(entry)
+    except (ValueError, KeyError) as error:
+        log(0, "ERROR: badly formatted plan file " + path_to_plan_file + ": " + str(error))
+        return 2
+
+    moved_paths = {entry['destination']: entry['path'] for entry in entries['move']}
+
+    # Files are moved up first, as deletions are planned at the place files are moved to
+    moves = []
+    for entry in get_unchanged_entries(entries['move'], {}):
+        if os.path.lexists(entry['destination']):
+            log_action(1, 'skip-move', entry['path'], "name already exists",
+                       "Will not move up file, as it already exists: " + entry['path'])
+        else:
+            if IS_DRY_RUN:
+                log_action(2, 'would-move', entry['path'], None, "Would move up file: " + entry['path'])
+            else:
+                log_action(2, 'move', entry['path'], None, "Moving up file: " + entry['path'])
+            moves.append((entry['path'], entry['destination']))
+
+    if not IS_DRY_RUN:
+        for move, result, error in run_jobs(lambda move: move_file(*move), moves):
+            if error:
+                log(0, "ERROR: could not move up file " + move[0] + ": " + str(error))
+
+    if STATS is not None:
+        STATS.count('files_moved', len(moves))
+
+    for entry in entries['remove-dir']:
+        if IS_DRY_RUN:
+            log(1, "Would remove directory: " + entry['path'])
+        else:
+            try:
+                os.rmdir(entry['path'])
+                log(1, "Removing directory: " + entry['path'])
+            except OSError:
+                log(1, "Will not remove directory, as it is not empty: " + entry['path'])
+
+    names_by_dir = {}
+    for entry in get_unchanged_entries(entries['delete'], moved_paths):
+        if IS_DRY_RUN:
+            log_action(1, 'would-delete', entry['path'], None, "Would delete: " + entry['path'])
+        else:
+            log_action(1, 'delete', entry['path'], None, "Deleting: " + entry['path'])
+        names_by_dir.setdefault(os.path.dirname(entry['path']), []).append(os.path.basename(entry['path']))
+        DELETED_FILES_COUNT += 1
+        if STATS is not None:
+            STATS.count('files_deleted')
+            STATS.count('bytes_reclaimed', entry['size'] or 0)
+
+    for entry in entries['delete-dir']:
+        if IS_DRY_RUN:
+            log(1, "Would delete directory: " + entry['path'])
+        else:
+            log(1, "Deleting directory: " + entry['path'])
+
+    if not IS_DRY_RUN:
+        delete_files(names_by_dir)
+        for entry in entries['delete-dir']:
+            shutil.rmtree(entry['path'], ignore_errors=True)
+
+    log(1, "\nApplied plan: " + str(len(moves)) + " / " + str(len(entries['move'])) + " moves, " +
+           str(DELETED_FILES_COUNT) + " / " + str(len(entries['delete'])) + " deletions")
+
+    return 0
+
+
+def get_bioses_from_roms_and_dat(inventory, path_to_dat_file):
+
+    bios_list = []
+
+    bioses = set(get_dat_index(path_to_dat_file).get_bioses(inventory.get_rom_names()))
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in bioses:
+            log(2, "Found BIOS ROM: " + rom)
+            bios_list.append(rom)
+
+    return bios_list
+
+
+def del_files_without(inventory, inclusion_list_string):
+
     log(0, "\nRemoving files with name NOT matching all of input patterns...\n")
 
     inclusion_list = check_and_get_patterns_list(inclusion_list_string)
@@ -174,25 +2069,16 @@ def del_files_without(path_to_roms_dir, inclusion_list_string):
     if not inclusion_list:
         return 2
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            for pattern in inclusion_list:
-                if not pattern.lower() in filename.lower():
-                    full_name = os.path.join(dirname, filename)
-                    if IS_DRY_RUN:
-                        log(1, "Would delete: " + filename)
-                    else:
-                        log(1, "Deleting: " + filename)
-                        os.remove(full_name)
-                    DELETED_FILES_COUNT += 1
-                    break
+    matcher = PatternMatcher(inclusion_list)
 
-    return 0
+    for file in inventory.get_files():
+        if not matcher.matches_all(file.name):
+            inventory.delete_file(file, ": " + file.name)
 
+    return 0
 
-def del_files_with(path_to_roms_dir, exclusion_list_string):
 
-    global DELETED_FILES_COUNT
+def del_files_with(inventory, exclusion_list_string):
 
     log(0, "\nRemoving files with name matching any of input patterns...\n")
 
@@ -201,25 +2087,16 @@ def del_files_with(path_to_roms_dir, exclusion_list_string):
     if not exclusion_list:
         return 2
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            for pattern in exclusion_list:
-                if pattern.lower() in filename.lower():
-                    full_name = os.path.join(dirname, filename)
-                    if IS_DRY_RUN:
-                        log(1, "Would delete: " + filename)
-                    else:
-                        log(1, "Deleting: " + filename)
-                        os.remove(full_name)
-                    DELETED_FILES_COUNT += 1
-                    break
+    matcher = PatternMatcher(exclusion_list)
 
-    return 0
+    for file in inventory.get_files():
+        if matcher.search(file.name):
+            inventory.delete_file(file, ": " + file.name)
 
+    return 0
 
-def del_pal_or_ntsc_files(path_to_roms_dir, del_ntsc_versions):
 
-    global DELETED_FILES_COUNT
+def del_pal_or_ntsc_files(inventory, del_ntsc_versions):
 
     if del_ntsc_versions:
         log(0, "\nRemoving NTSC versions of ROMs...\n")
@@ -228,534 +2105,849 @@ def del_pal_or_ntsc_files(path_to_roms_dir, del_ntsc_versions):
 
     files_list = []
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
+    for rom_file in inventory.get_files():
+        filename = rom_file.name
+        file_attributes                  = {}
+        file_attributes['parent_dir']    = rom_file.parent_dir
+        file_attributes['name']          = filename
+        file_attributes['rom']           = rom_file.get_rom_name().group_key
+        file_attributes['file']          = rom_file
+        file_attributes['to_be_deleted'] = False
+        file_attributes['is_pal']        = rom_file.get_rom_name().is_pal
+        files_list.append(file_attributes)
+
+    # Group versions of a same ROM in a same directory
+    versions_groups = {}
+    for file in files_list:
+        versions_groups.setdefault((file['parent_dir'], file['rom']), []).append(file)
+
+    # Only when both PAL and NTSC versions of a ROM are found, delete the unwanted ones
+    for versions in versions_groups.values():
+        has_pal  = any(file['is_pal'] for file in versions)
+        has_ntsc = not all(file['is_pal'] for file in versions)
+        if has_pal and has_ntsc:
+            for file in versions:
+                file['to_be_deleted'] = file['is_pal'] != del_ntsc_versions
+
+    for file in files_list:
+        if file['to_be_deleted']:
+            inventory.delete_file(file['file'], ": " + file['name'])
+
+    return 0
+
+# Get directory holding ROMs for input directory, if it is a scraped images directory; input
+# directory shall be absolute, so that images directories are told even when ROMs one is "."
+def get_images_roms_dir(dirname):
+
+    for images_dir in MEDIA_IMAGES_DIRS:
+        if dirname.endswith(os.sep + images_dir):
+            return dirname[:-len(images_dir) - 1]
+
+    return None
+
+
+def del_roms_without_image(inventory):
+
+    log(0, "\nRemoving ROMs without an image...\n")
+
+    # List each ROMs directory images once, as sets of names without extension
+    images_by_roms_dir = {}
+    for file in inventory.get_files():
+        rom_name = file.get_rom_name()
+        if rom_name.extension.lower() in IMAGE_EXTENSIONS:
+            roms_dir = get_images_roms_dir(os.path.abspath(file.parent_dir))
+            if roms_dir is not None:
+                images_by_roms_dir.setdefault(roms_dir, set()).add(rom_name.stem)
+
+    # Scraped media directories are told once per directory
+    is_media_dir = {}
+    for dirname in inventory.dirs:
+        relative_dir = os.path.relpath(dirname, inventory.path_to_roms_dir)
+        is_media_dir[dirname] = 'media' in relative_dir.split(os.sep)
+
+    for file in inventory.get_files():
+        rom_name  = file.get_rom_name()
+        extension = rom_name.extension
+        # Images, other scraped media files and ROMs metadata are not ROMs
+        if extension.lower() in IMAGE_EXTENSIONS or extension == '.xml' or extension == '.txt' or \
+           is_media_dir.get(file.parent_dir):
+            continue
+        if rom_name.stem not in images_by_roms_dir.get(os.path.abspath(file.parent_dir), ()):
+            inventory.delete_file(file, ": " + file.name)
+
+    return 0
+
+def del_images_without_rom(inventory):
+
+    log(0, "\nRemoving images without a ROM file...\n")
+
+    # List each ROMs directory once, as sets of names without extension
+    roms_by_dir = {}
+    for file in inventory.get_files():
+        roms_by_dir.setdefault(os.path.abspath(file.parent_dir), set()).add(file.get_rom_name().stem)
+    scanned_dirs = set(os.path.abspath(dirname) for dirname in inventory.dirs)
+
+    for file in inventory.get_files():
+        rom_name = file.get_rom_name()
+        if rom_name.extension.lower() not in IMAGE_EXTENSIONS:
+            continue
+        roms_dir = get_images_roms_dir(os.path.abspath(file.parent_dir))
+        if roms_dir is None:
+            continue
+        # ROMs directory may be out of the scanned one, e.g. when cleaning media/images only
+        if roms_dir not in scanned_dirs:
+            scanned_dirs.add(roms_dir)
+            try:
+                roms_by_dir[roms_dir] = set(os.path.splitext(rom)[0] for rom in os.listdir(roms_dir))
+            except OSError as error:
+                log(1, "WARNING: could not list ROMs directory " + roms_dir + ": " + str(error))
+                continue
+        if rom_name.stem not in roms_by_dir.get(roms_dir, ()):
+            inventory.delete_file(file, ": " + file.name)
+
+    return 0
+
+def del_variant_files(inventory, del_first_variants):
+
+    if del_first_variants:
+        log(0, "\nRemoving first variants of ROMs...\n")
+    else:
+        log(0, "\nRemoving last variants of ROMs...\n")
+
+    files_list = []
+
+    for rom_file in inventory.get_files():
+        filename = rom_file.name
+        file_attributes                  = {}
+        file_attributes['parent_dir']    = rom_file.parent_dir
+        file_attributes['name']          = filename
+        file_attributes['rom']           = rom_file.get_rom_name().group_key
+        file_attributes['file']          = rom_file
+        file_attributes['to_be_deleted'] = False
+        files_list.append(file_attributes)
+
+    # Group variants of a same ROM in a same directory, keeping their scan order
+    variants_groups = {}
+    for file in files_list:
+        variants_groups.setdefault((file['parent_dir'], file['rom']), []).append(file)
+
+    # Only keep the last variant of each group, or the first one
+    for variants in variants_groups.values():
+        if del_first_variants:
+            kept_variant = variants[-1]
+        else:
+            kept_variant = variants[0]
+        for file in variants:
+            if file is not kept_variant:
+                file['to_be_deleted'] = True
+
+    for file in files_list:
+        if file['to_be_deleted']:
+            inventory.delete_file(file['file'], ": " + file['name'])
+
+    return 0
+
+
+def del_variant_files_from_string(inventory, match_list_string, del_with_string):
+
+    log(0, "\nRemoving first variants of ROMs NOT matching any of input patterns...\n")
+
+    match_list = check_and_get_patterns_list(match_list_string)
+
+    if not match_list:
+        return 2
+
+    matcher = PatternMatcher(match_list)
+
+    files_list = []
+
+    for rom_file in inventory.get_files():
+        filename = rom_file.name
+        rom_name = rom_file.get_rom_name()
+        if rom_name.variant is not None:
             file_attributes                  = {}
-            file_attributes['parent_dir']    = dirname
+            file_attributes['parent_dir']    = rom_file.parent_dir
             file_attributes['name']          = filename
-            file_attributes['rom']           = filename.split("(")[0].strip().lower()
-            file_attributes['full_name']     = os.path.join(dirname, filename)
+            file_attributes['rom']           = rom_name.group_key
+            file_attributes['variant']       = rom_name.variant
+            file_attributes['file']          = rom_file
             file_attributes['to_be_deleted'] = False
-            if '(PAL' in filename:
-                file_attributes['is_pal'] = True
-            elif '(NTSC' in filename:
-                file_attributes['is_pal'] = False
-            # In case nor PAL and NTSC is showing up, assume the ROM is NTSC
-            else:
-                file_attributes['is_pal'] = False
             files_list.append(file_attributes)
+        else:
+            log(1, "Ignoring: " + filename)
 
+    # Group variants of a same ROM in a same directory
+    variants_groups = {}
     for file in files_list:
-        for file2 in files_list:
-            if file['parent_dir'] == file2['parent_dir']:
-                if file['name'] == file2['name']:
-                    break
+        variants_groups.setdefault((file['parent_dir'], file['rom']), []).append(file)
+
+    # Only consider ROMs having several variants, matching each variant once
+    for variants in variants_groups.values():
+        if len(variants) > 1:
+            for file in variants:
+                if del_with_string:
+                    file['to_be_deleted'] = matcher.search(file['variant']) is not None
                 else:
-                    if file['rom'] == file2['rom']:
-                        if file['is_pal'] and not file2['is_pal']:
-                            if del_ntsc_versions:
-                                file2['to_be_deleted'] = True
-                            else:
-                                file['to_be_deleted'] = True
-                            break
+                    file['to_be_deleted'] = not matcher.matches_all(file['variant'])
 
     for file in files_list:
         if file['to_be_deleted']:
-            if IS_DRY_RUN:
-                log(1, "Would delete: " + file['name'])
-            else:
-                log(1, "Deleting: " + file['name'])
-                os.remove(file['full_name'])
-            DELETED_FILES_COUNT += 1
+            inventory.delete_file(file['file'], ": " + file['name'])
 
     return 0
 
-def del_roms_without_image(path_to_roms_dir):
 
-    global DELETED_FILES_COUNT
+# Get a sortable key of a revision, e.g. "1.1" or "A"; an unrevised ROM comes first
+def get_revision_key(revision):
 
-    log(0, "\nRemoving ROMs without a PNG image...\n")
+    if revision is None:
+        return ()
 
-    files_list = []
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part.lower()) for part in revision.split('.'))
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            file_attributes               = {}
-            file_attributes['parent_dir'] = dirname
-            file_attributes['name']       = filename
-            file_attributes['rom']        = os.path.splitext(filename)[0]
-            file_attributes['extension']  = os.path.splitext(filename)[1]
-            file_attributes['full_name']  = os.path.join(dirname, filename)
-            
-            if file_attributes['extension'] == '.png' or file_attributes['extension'] == '.xml' or file_attributes['extension'] == '.txt':
-                pass
-            else:
-                image_path = os.path.join(file_attributes['parent_dir'], 'media', 'images', file_attributes['rom']) + '.png'
-                if os.path.isfile(image_path.replace("\\","/")):
-                    file_attributes['to_be_deleted'] = False
+
+def del_variant_files_but_best(inventory, preferences_list_string):
+
+    log(0, "\nRemoving all variants of ROMs but the best one...\n")
+
+    preferences_list = check_and_get_preferences_list(preferences_list_string)
+
+    if not preferences_list:
+        return 2
+
+    ranks = {preference: rank for rank, preference in reversed(list(enumerate(preferences_list)))}
+
+    # Best variants have the most preferred region or language, then are verified, then have
+    # the highest revision; on a tie, the first variant found is the best one
+    def get_score(file):
+        rom_name = file.get_rom_name()
+        rank     = min([ranks.get(region.lower(), len(ranks)) for region in rom_name.regions] +
+                       [ranks.get(language.lower(), len(ranks)) for language in rom_name.languages] +
+                       [len(ranks)])
+        return (-rank, '!' in rom_name.flags, get_revision_key(rom_name.revision))
+
+    # Group variants of a same ROM in a same directory: they have the same title, and the same
+    # tags but for regions, languages, revision and flags, so that e.g. each disc or track of a
+    # ROM is handled on its own; files of a variant, i.e. with a same name but for extension,
+    # e.g. .cue and .bin ones, are kept or deleted together
+    variants_groups = {}
+    for file in inventory.get_files():
+        rom_name = file.get_rom_name()
+        if not rom_name.tags and not rom_name.flags:
+            log(1, "Ignoring: " + file.name)
+            continue
+        variants = variants_groups.setdefault((file.parent_dir, rom_name.lowered_title, rom_name.other_tags), {})
+        variants.setdefault(rom_name.stem, []).append(file)
+
+    for variants in variants_groups.values():
+        if len(variants) < 2:
+            continue
+        best_stem = max(variants, key=lambda stem: get_score(variants[stem][0]))
+        for stem, files in variants.items():
+            if stem != best_stem:
+                for file in files:
+                    inventory.delete_file(file, ": " + file.name, "variant of " + variants[best_stem][0].name)
+
+    return 0
+
+
+def get_reference_files(reference_roms_dirs):
+
+    reference_files = {}
+
+    # Scan reference directories once, indexing their files by name; a same name may be
+    # found several times, in different subdirectories or reference directories
+    for path_to_reference_roms_dir in reference_roms_dirs:
+        for reference_file in Inventory(path_to_reference_roms_dir).scan().files:
+            reference_files.setdefault(reference_file.name, []).append(reference_file)
+
+    return reference_files
+
+
+def del_duplicates(inventory, path_to_dat_file, reference_roms_dirs):
+
+    log(0, "\nRemoving duplicates in alternate ROMs directory...\n")
+
+    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
+    bios_list = get_bioses_from_roms_and_dat(inventory, path_to_dat_file)
+
+    reference_files = get_reference_files(reference_roms_dirs)
+
+    for file in inventory.get_files():
+        if file.name not in reference_files:
+            continue
+        size = file.get_stat().st_size
+        for reference_file in reference_files[file.name]:
+            if file.get_rom_name().stem in bios_list:
+                if IS_DRY_RUN:
+                    log(2, "Would keep BIOS: " + reference_file.full_name)
                 else:
-                    file_attributes['to_be_deleted'] = True
-                files_list.append(file_attributes)
+                    log(2, "Keeping BIOS: " + reference_file.full_name)
+            elif size == reference_file.get_stat().st_size:
+                inventory.delete_file(file, " " + file.full_name + ", duplicate of " + reference_file.full_name,
+                                      "duplicate of " + reference_file.full_name)
+                break
 
-    for file in files_list:
-        if file['to_be_deleted']:
-            if IS_DRY_RUN:
-                log(1, "Would delete: " + file['name'])
+    return 0
+
+
+# Group input files by key, computed in parallel, only keeping groups of several files
+def group_files_by(files, get_key):
+
+    groups = {}
+
+    for file, key, error in run_jobs(get_key, files):
+        if error:
+            log(1, "WARNING: ignoring unreadable file " + file.full_name + ": " + str(error))
+        else:
+            groups.setdefault(key, []).append(file)
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def del_content_duplicates(inventory, path_to_dat_file, reference_roms_dirs):
+
+    log(0, "\nRemoving files with same content as another file...\n")
+
+    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
+    if path_to_dat_file:
+        bios_list = get_bioses_from_roms_and_dat(inventory, path_to_dat_file)
+    else:
+        bios_list = []
+
+    # Reference files come first, so that they are the ones kept among duplicates
+    reference_files = []
+    for path_to_reference_roms_dir in reference_roms_dirs or []:
+        reference_files += Inventory(path_to_reference_roms_dir).scan().files
+
+    # Most files have a unique size, so that they never need to be read at all; then
+    # compare a hash of the beginning of the files, and only then a hash of whole files
+    stats = {}
+    for file, stat, error in run_jobs(lambda file: file.get_stat(), reference_files + inventory.get_files()):
+        if error:
+            log(1, "WARNING: ignoring unreadable file " + file.full_name + ": " + str(error))
+        elif stat.st_size > 0:
+            stats[file] = stat
+
+    # Files are identified by device and inode, as a reference directory may be found in the
+    # ROMs directory under another path, listing its files twice
+    def get_inode(file):
+        return (stats[file].st_dev, stats[file].st_ino)
+
+    reference_inodes = set(get_inode(file) for file in reference_files if file in stats)
+
+    size_groups = group_files_by(list(stats), lambda file: stats[file].st_size)
+
+    # Digests of unchanged files are read from the cache, other ones are saved there
+    digest_cache   = open_digest_cache()
+    digests        = {file: digest_cache.get(stats[file]) for size_group in size_groups for file in size_group}
+    computed_files = set()
+
+    def get_partial_sha1(file):
+        if 'partial_sha1' not in digests[file]:
+            digests[file]['partial_sha1'] = get_file_sha1(file.full_name, PARTIAL_HASH_SIZE)
+            computed_files.add(file)
+        return digests[file]['partial_sha1']
+
+    def get_sha1(file):
+        if 'sha1' not in digests[file]:
+            digests[file].update(get_file_digests(file.full_name))
+            computed_files.add(file)
+        return digests[file]['sha1']
+
+    partial_groups = []
+    for size_group in size_groups:
+        partial_groups += group_files_by(size_group, get_partial_sha1)
+    log(2, "Files sharing size: " + str(sum(len(group) for group in size_groups)) +
+           ", sharing size and beginning: " + str(sum(len(group) for group in partial_groups)))
+
+    duplicates_groups = []
+    for partial_group in partial_groups:
+        if stats[partial_group[0]].st_size <= PARTIAL_HASH_SIZE:
+            duplicates_groups.append(partial_group)
+        else:
+            duplicates_groups += group_files_by(partial_group, get_sha1)
+
+    for file in computed_files:
+        digest_cache.put(stats[file], digests[file])
+    digest_cache.close()
+    log(2, "Files read: " + str(len(computed_files)) + ", digests found in cache: " + str(len(digests) - len(computed_files)))
+
+    if STATS is not None:
+        STATS.count('files_hashed', len(computed_files))
+        STATS.count('digests_from_cache', len(digests) - len(computed_files))
+
+    for duplicates in duplicates_groups:
+        kept_file = duplicates[0]
+        for file in duplicates[1:]:
+            if get_inode(file) in reference_inodes or get_inode(file) == get_inode(kept_file):
+                continue
+            if file.get_rom_name().stem in bios_list:
+                if IS_DRY_RUN:
+                    log(2, "Would keep BIOS: " + file.full_name)
+                else:
+                    log(2, "Keeping BIOS: " + file.full_name)
             else:
-                log(1, "Deleting: " + file['name'])
-                os.remove(file['full_name'])
-            DELETED_FILES_COUNT += 1
+                inventory.delete_file(file, " " + file.full_name + ", same content as " + kept_file.full_name,
+                                      "same content as " + kept_file.full_name)
 
     return 0
 
-def del_images_without_rom(path_to_roms_dir):
 
-    global DELETED_FILES_COUNT
+def del_roms_clones(inventory, path_to_dat_file):
 
-    log(0, "\nRemoving PNGs without a ROM file...\n")
+    log(0, "\nRemoving clones of ROMs...\n")
 
-    files_list = []
+    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
+    bios_list = get_bioses_from_roms_and_dat(inventory, path_to_dat_file)
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            file_attributes               = {}
-            file_attributes['parent_dir'] = dirname
-            file_attributes['name']       = filename
-            file_attributes['rom']        = os.path.splitext(filename)[0]
-            file_attributes['extension']  = os.path.splitext(filename)[1]
-            file_attributes['full_name']  = os.path.join(dirname, filename)
-            
-            if file_attributes['extension'] != '.png':
-                pass
-            else:
-                rom_path = os.path.join(file_attributes['parent_dir'], '..', '..', glob.escape(file_attributes['rom'])) + '.*'
-                if len(glob.glob(rom_path.replace("\\","/"))) == 0:
-                    file_attributes['to_be_deleted'] = True
+    dat_index = get_dat_index(path_to_dat_file)
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        game = dat_index.get(rom)
+        if game:
+            if (game.romof and game.romof not in bios_list) or game.cloneof or game.sampleof:
+                inventory.delete_file(file, " " + file.full_name)
+
+    return 0
+
+
+def del_roms_with_samples(inventory, path_to_dat_file):
+
+    log(0, "\nDeleting ROMs with samples...\n")
+
+    roms_with_samples = get_dat_index(path_to_dat_file).get_with_samples(inventory.get_rom_names())
+
+    log(2, "ROMs with samples: " + str(roms_with_samples))
+
+    roms_with_samples = set(roms_with_samples)
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in roms_with_samples:
+            inventory.delete_file(file, " " + file.full_name)
+
+    for dirname in inventory.dirs:
+        if os.path.basename(dirname) == "samples" and not inventory.is_deleted_dir(dirname):
+            inventory.delete_dir(dirname, " samples directory: " + dirname)
+
+    return 0
+
+
+def del_roms_older_than(inventory, path_to_dat_file, year_string):
+
+    log(0, "\nDeleting ROMs older than " + year_string + " \n")
+
+    year_integer = check_and_get_year(year_string)
+
+    if year_integer is None:
+        return 2
+
+    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
+    bios_list = get_bioses_from_roms_and_dat(inventory, path_to_dat_file)
+
+    # In case the year string in .dat file is corrupt, e.g. "198?", ROM is deemed older, to force its deletion
+    older_roms = get_dat_index(path_to_dat_file).get_older_than(year_integer, inventory.get_rom_names())
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in older_roms:
+            rom_year_string = older_roms[rom]
+            if rom in bios_list:
+                if IS_DRY_RUN:
+                    log(2, "Would keep BIOS: " + file.full_name)
                 else:
-                    file_attributes['to_be_deleted'] = False
-                files_list.append(file_attributes)
+                    log(2, "Keeping BIOS: " + file.full_name)
+            else:
+                inventory.delete_file(file, ": " + file.name + " (\"" + rom_year_string + "\")", rom_year_string)
+
+    return 0
+
+
+def del_if_description_has(inventory, path_to_dat_file, exclusion_list_string):
+
+    log(0, "\nDeleting files with description matching any of input patterns...\n")
+
+    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+
+    if not exclusion_list:
+        return 2
+
+    matcher       = PatternMatcher(exclusion_list)
+    matching_roms = get_dat_index(path_to_dat_file).get_matching('description', matcher, inventory.get_rom_names())
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in matching_roms:
+            description = matching_roms[rom]
+            inventory.delete_file(file, ": " + file.name + " (\"" + description + "\")", description)
+
+    return 0
+
+
+def del_if_manufacturer_has(inventory, path_to_dat_file, exclusion_list_string):
+
+    log(0, "\nDeleting files with manufacturer matching any of input patterns...\n")
+
+    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+
+    if not exclusion_list:
+        return 2
+
+    matcher       = PatternMatcher(exclusion_list)
+    matching_roms = get_dat_index(path_to_dat_file).get_matching('manufacturer', matcher, inventory.get_rom_names())
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in matching_roms:
+            manufacturer = matching_roms[rom]
+            inventory.delete_file(file, ": " + file.name + " (\"" + manufacturer + "\")", manufacturer)
+
+    return 0
+
+
+def del_if_comment_has(inventory, path_to_dat_file, exclusion_list_string):
+
+    log(0, "\nDeleting files with comment matching any of input patterns...\n")
+
+    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+
+    if not exclusion_list:
+        return 2
+
+    matcher       = PatternMatcher(exclusion_list)
+    matching_roms = get_dat_index(path_to_dat_file).get_matching('comment', matcher, inventory.get_rom_names())
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in matching_roms:
+            comment = matching_roms[rom]
+            inventory.delete_file(file, ": " + file.name + " (\"" + comment + "\")", comment)
+
+    return 0
+
+
+def del_if_bios_is(inventory, path_to_dat_file, input_bios_list_string, del_on_match):
+
+    if del_on_match:
+        log(0, "\nRemoving ROMs matching input BIOS(es)...\n")
+    else:
+        log(0, "\nRemoving ROMs NOT matching input BIOS(es)...\n")
+
+    input_bios_list = check_and_get_bioses_list(input_bios_list_string)
+
+    if not input_bios_list:
+        return 2
 
-    for file in files_list:
-        if file['to_be_deleted']:
-            if IS_DRY_RUN:
-                log(1, "Would delete: " + file['name'])
+    roots = get_dat_index(path_to_dat_file).resolve_roots(inventory.get_rom_names())
+
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in roots:
+            root, is_bios = roots[rom]
+            if root and is_bios:
+                log(2, rom + " root ROM is a BIOS: " + root)
+                if (del_on_match and root.lower() in input_bios_list) or\
+                   (not del_on_match and root.lower() not in input_bios_list):
+                    inventory.delete_file(file, ": " + file.name + " (" + root + ")", root)
+            elif root:
+                log(2, rom + " root ROM is no BIOS but: " + root + "; keeping ROM")
             else:
-                log(1, "Deleting: " + file['name'])
-                os.remove(file['full_name'])
-            DELETED_FILES_COUNT += 1
+                log(2, rom + " got not root ROM; keeping ROM")
 
     return 0
 
-def del_variant_files(path_to_roms_dir, del_first_variants):
 
-    global DELETED_FILES_COUNT
+def del_where(inventory, path_to_dat_file, expression_string):
 
-    if del_first_variants:
-        log(0, "\nRemoving first variants of ROMs...\n")
-    else:
-        log(0, "\nRemoving last variants of ROMs...\n")
+    log(0, "\nDeleting ROMs matching input expression...\n")
 
-    files_list = []
+    expression = check_and_get_expression(expression_string)
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            file_attributes                  = {}
-            file_attributes['parent_dir']    = dirname
-            file_attributes['name']          = filename
-            file_attributes['rom']           = filename.split("(")[0].strip().lower()
-            file_attributes['full_name']     = os.path.join(dirname, filename)
-            file_attributes['to_be_deleted'] = False
-            files_list.append(file_attributes)
+    if expression is None:
+        return 2
 
-    for file in files_list:
-        for file2 in files_list:
-            if file['parent_dir'] == file2['parent_dir']:
-                if file['name'] == file2['name']:
-                    break
-                else:
-                    if file['rom'] == file2['rom'] and not file2['to_be_deleted']:
-                        if del_first_variants:
-                            file2['to_be_deleted'] = True
-                        else:
-                            file['to_be_deleted'] = True
-                        break
+    matching_roms = get_dat_index(path_to_dat_file).get_where(expression, inventory.get_rom_names())
 
-    for file in files_list:
-        if file['to_be_deleted']:
-            if IS_DRY_RUN:
-                log(1, "Would delete: " + file['name'])
-            else:
-                log(1, "Deleting: " + file['name'])
-                os.remove(file['full_name'])
-            DELETED_FILES_COUNT += 1
+    for file in inventory.get_files():
+        rom = file.get_rom_name().stem
+        if rom in matching_roms:
+            inventory.delete_file(file, ": " + file.name, expression_string)
 
     return 0
 
 
-def del_variant_files_from_string(path_to_roms_dir, match_list_string, del_with_string):
-
-    global DELETED_FILES_COUNT
-
-    log(0, "\nRemoving first variants of ROMs NOT matching any of input patterns...\n")
+def check_and_get_expression(expression_string):
 
-    match_list = check_and_get_patterns_list(match_list_string)
+    try:
+        return DatExpression(expression_string)
+    except ValueError as error:
+        log(0, "ERROR: bad input expression (\"" + expression_string + "\"): " + str(error))
+        return None
 
-    if not match_list:
-        return 2
 
-    files_list = []
+# Statuses of archives, once audited against ROMs of their game in .dat file
+ZIP_COMPLETE        = "complete"
+ZIP_MISSING_MEMBERS = "missing members"
+ZIP_WRONG_CRC       = "wrong CRC"
+ZIP_UNREADABLE      = "unreadable"
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            if "(" in filename and ")" in filename:
-                file_attributes                  = {}
-                file_attributes['parent_dir']    = dirname
-                file_attributes['name']          = filename
-                file_attributes['rom']           = filename.split("(")[0].strip().lower()
-                file_attributes['variant']       = filename.split("(")[1].strip().lower()
-                file_attributes['full_name']     = os.path.join(dirname, filename)
-                file_attributes['to_be_deleted'] = False
-                files_list.append(file_attributes)
-            else:
-                log(1, "Ignoring: " + filename)
+# Status of archives which could not be read, e.g. denied or on a share gone offline; as
+# this may not last, they are only reported, and never deleted
+ZIP_READ_ERROR      = "read error"
 
-    for file in files_list:
-        for file2 in files_list:
-            if file['parent_dir'] == file2['parent_dir']:
-                if file['name'] == file2['name']:
-                    pass
-                else:
-                    if file['rom'] == file2['rom']:
-                        for pattern in match_list:
-                            if del_with_string == True:
-                                if pattern.lower() in file2['variant']:
-                                    file2['to_be_deleted'] = True
-                                    break
-                            else:
-                                if pattern.lower() in file2['variant']:
-                                    file2['to_be_deleted'] = False
-                                else:
-                                    file2['to_be_deleted'] = True
-                                    break
 
-    for file in files_list:
-        if file['to_be_deleted']:
-            if IS_DRY_RUN:
-                log(1, "Would delete: " + file['name'])
-            else:
-                log(1, "Deleting: " + file['name'])
-                os.remove(file['full_name'])
-            DELETED_FILES_COUNT += 1
+def get_zip_members(path_to_zip_file):
 
-    return 0
+    # Only read the central directory of the archive, giving names, sizes and CRC32 of
+    # its members; nothing is decompressed
+    try:
+        with zipfile.ZipFile(path_to_zip_file) as zip_file:
+            return {info.filename.lower(): (info.file_size, info.CRC) for info in zip_file.infolist()}
+    except zipfile.BadZipFile:
+        return None
 
 
-def del_duplicates(path_to_roms_dir, path_to_dat_file, path_to_reference_roms_dir):
+def audit_zip_members(dat_index, game, members):
 
-    global DELETED_FILES_COUNT
+    roms = game.roms
 
-    log(0, "\nRemoving duplicates in alternate ROMs directory...\n")
+    # ROMs of a parent BIOS are found in the BIOS archive, not in the game one
+    root, is_bios = dat_index.get_root(game.name)
+    if is_bios and root != game.name:
+        bios_crcs = set(rom[2] for rom in dat_index.get(root).roms)
+        roms = [rom for rom in roms if rom[2] not in bios_crcs]
 
-    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
-    bios_list = get_bioses_from_roms_and_dat(path_to_roms_dir, path_to_dat_file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            for dirname2, dirnames2, filenames2 in os.walk(path_to_reference_roms_dir):
-                for filename2 in filenames2:
-                    if filename == filename2:
-                        full_name = os.path.join(dirname, filename)
-                        size = os.path.getsize(full_name)
-                        full_name2 = os.path.join(dirname2, filename2)
-                        size2 = os.path.getsize(full_name2)
-                        if filename.split(".")[0] in bios_list:
-                            if IS_DRY_RUN:
-                                log(2, "Would keep BIOS: " + full_name2)
-                            else:
-                                log(2, "Keeping BIOS: " + full_name2)
-                        elif size == size2:
-                            if IS_DRY_RUN:
-                                log(1, "Would delete " + full_name + ", duplicate of " + full_name2)
-                            else:
-                                log(1, "Deleting " + full_name + ", duplicate of " + full_name2)
-                                os.remove(full_name)
-                            DELETED_FILES_COUNT += 1
+    missing_roms = []
+    wrong_roms   = []
 
-    return 0
+    for name, size, crc, merged_name in roms:
+        member = members.get(name.lower())
+        # ROMs merged with parent ones are only found in clone archives of non-merged sets,
+        # not of split sets, so that they are only checked when found
+        if not member:
+            if not merged_name:
+                missing_roms.append(name)
+        elif member[1] != crc or (size >= 0 and member[0] != size):
+            wrong_roms.append(name)
 
+    if missing_roms:
+        return ZIP_MISSING_MEMBERS, ", ".join(missing_roms)
+    elif wrong_roms:
+        return ZIP_WRONG_CRC, ", ".join(wrong_roms)
+    else:
+        return ZIP_COMPLETE, ""
 
-def del_roms_clones(path_to_roms_dir, path_to_dat_file):
 
-    global DELETED_FILES_COUNT
+def audit_zips(inventory, path_to_dat_file, del_bad_zips):
 
-    log(0, "\nRemoving clones of ROMs...\n")
+    if del_bad_zips:
+        log(0, "\nRemoving ZIP archives not matching .dat file ROMs...\n")
+    else:
+        log(0, "\nAuditing ZIP archives against .dat file ROMs...\n")
 
-    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
-    bios_list = get_bioses_from_roms_and_dat(path_to_roms_dir, path_to_dat_file)
-
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            nodes = tree.findall('.//game[@name="' + rom + '"]')
-            if len(nodes) != 0:
-                rom_of = nodes[0].attrib.get("romof")
-                clone_of = nodes[0].attrib.get("cloneof")
-                sample_of = nodes[0].attrib.get("sampleof")
-                if (rom_of and rom_of not in bios_list) or clone_of or sample_of:
-                    full_name = os.path.join(dirname, filename)
-                    if IS_DRY_RUN:
-                        log(1, "Would delete " + full_name)
-                    else:
-                        log(1, "Deleting " + full_name)
-                        os.remove(full_name)
-                    DELETED_FILES_COUNT += 1
+    dat_index = get_dat_index(path_to_dat_file, with_roms=True)
 
-    return 0
+    zip_files = [file for file in inventory.get_files()
+                 if file.get_rom_name().extension.lower() == '.zip' and file.get_rom_name().stem in dat_index]
 
+    statuses_counts = {ZIP_COMPLETE: 0, ZIP_MISSING_MEMBERS: 0, ZIP_WRONG_CRC: 0, ZIP_UNREADABLE: 0, ZIP_READ_ERROR: 0}
 
-def del_roms_with_samples(path_to_roms_dir, path_to_dat_file):
+    if STATS is not None:
+        STATS.count('zips_read', len(zip_files))
 
-    global DELETED_FILES_COUNT
+    for file, members, error in run_jobs(lambda file: get_zip_members(file.full_name), zip_files):
+        if error:
+            statuses_counts[ZIP_READ_ERROR] += 1
+            log(0, "ERROR: could not read archive " + file.full_name + ": " + str(error))
+            continue
+        elif members is None:
+            status, details = ZIP_UNREADABLE, "not a ZIP archive"
+        else:
+            status, details = audit_zip_members(dat_index, dat_index.get(file.get_rom_name().stem), members)
+        statuses_counts[status] += 1
+        if status == ZIP_COMPLETE:
+            log(2, "Complete: " + file.name)
+        elif del_bad_zips:
+            inventory.delete_file(file, ": " + file.name + " (" + status + ": " + details + ")", status + ": " + details)
+        else:
+            log_action(1, 'bad-archive', file.full_name, status + ": " + details,
+                       "Bad archive: " + file.name + " (" + status + ": " + details + ")")
 
-    log(0, "\nDeleting ROMs with samples...\n")
+    log(1, "\nAudited archives: " + ", ".join(str(count) + " " + status for status, count in statuses_counts.items()))
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
+    return 0
 
-    roms_with_samples = []
 
-    for sample in tree.findall('game/sample/..'):
-        rom = sample.attrib.get("name")
-        roms_with_samples.append(rom)
+def get_files_count(inventory):
 
-    log(2, "ROMs with samples: " + str(roms_with_samples))
+    files_count = 0
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            if rom in roms_with_samples:
-                full_name = os.path.join(dirname, filename)
-                if IS_DRY_RUN:
-                    log(1, "Would delete " + full_name)
-                else:
-                    log(1, "Deleting " + full_name)
-                    os.remove(full_name)
-                DELETED_FILES_COUNT += 1
+    for file in inventory.files:
+        # Deleted files are only gone in real runs
+        if file.is_deleted and not IS_DRY_RUN:
+            continue
+        file_extension  = file.get_rom_name().extension
+        if file_extension != '.png' and file_extension != '.xml' and file_extension != '.txt':
+            files_count += 1
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        if os.path.basename(dirname) == "samples":
-            if IS_DRY_RUN:
-                log(1, "Would delete samples directory: " + dirname)
-            else:
-                log(1, "Deleting samples directory: " + dirname)
-                shutil.rmtree(dirname, ignore_errors=True)
+    return files_count
 
-    return 0
 
+# Check input arguments of a cleaning stage, as checked again when the stage runs; only
+# errors are logged here, parsed values being logged by the stage
+def check_stage_arguments(stage):
 
-def del_roms_older_than(path_to_roms_dir, path_to_dat_file, year_string):
+    function = stage[0]
 
-    log(0, "\nDeleting ROMs older than " + year_string + " \n")
+    if function in (del_files_without, del_files_with, del_variant_files_from_string):
+        return bool(check_and_get_patterns_list(stage[1], is_verbose=False))
+    if function in (del_if_description_has, del_if_manufacturer_has, del_if_comment_has):
+        return bool(check_and_get_patterns_list(stage[2], is_verbose=False))
+    if function is del_variant_files_but_best:
+        return bool(check_and_get_preferences_list(stage[1], is_verbose=False))
+    if function is del_roms_older_than:
+        return check_and_get_year(stage[2]) is not None
+    if function is del_if_bios_is:
+        return bool(check_and_get_bioses_list(stage[2], is_verbose=False))
+    if function is del_where:
+        return check_and_get_expression(stage[2]) is not None
 
-    try:
-        year_integer = int(year_string)
-    except ValueError:
-        log(0, "ERROR: badl input year (\"" + year_string + "\"); please use an integer")
-        return 2
+    return True
 
-    # Get any BIOS ROM found in the input ROMs directory, to prevent removing them
-    bios_list = get_bioses_from_roms_and_dat(path_to_roms_dir, path_to_dat_file)
-
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            element = tree.findall('.//game[@name="' + rom + '"]/year')
-            if element:
-                rom_year_string = element[0].text
-                try:
-                    rom_year_integer = int(rom_year_string)
-                except ValueError:
-                    # In case the year string in .dat file is corrupt, e.g. "198?", force ROM deletion
-                    rom_year_integer = 0
-                if rom_year_integer < year_integer:
-                    full_name = os.path.join(dirname, filename)
-                    if rom in bios_list:
-                        if IS_DRY_RUN:
-                            log(2, "Would keep BIOS: " + full_name)
-                        else:
-                            log(2, "Keeping BIOS: " + full_name)
-                    else:
-                        if IS_DRY_RUN:
-                            log(1, "Would delete: " + filename + " (\"" + rom_year_string + "\")")
-                        else:
-                            log(1, "Deleting: " + filename + " (\"" + rom_year_string + "\")")
-                            os.remove(full_name)
-                        DELETED_FILES_COUNT += 1
 
-    return 0
+# Run all operations requested by input options, once these are checked
+def clean_roms(opts):
 
+    global CURRENT_RULE
 
-def del_if_description_has(path_to_roms_dir, path_to_dat_file, exclusion_list_string):
+    # A plan file holds all decisions already, so that nothing else is needed to apply it
+    if opts.apply_plan:
+        CURRENT_RULE = 'apply_plan'
+        with phase('apply_plan'):
+            return apply_plan(opts.apply_plan)
 
-    global DELETED_FILES_COUNT
+    plan = Plan() if opts.write_plan else None
 
-    log(0, "\nDeleting files with description matching any of input patterns...\n")
+    # All cleaning stages, in execution order, run over a single scan of the ROMs directory
+    stages = []
 
-    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+    if opts.del_files_without_string:
+        stages.append((del_files_without, opts.del_files_without_string))
 
-    if not exclusion_list:
-        return 2
+    if opts.del_files_with_string:
+        stages.append((del_files_with, opts.del_files_with_string))
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            element = tree.findall('.//game[@name="' + rom + '"]/description')
-            if element:
-                description = element[0].text
-                for pattern in exclusion_list:
-                    if pattern.lower() in description.lower():
-                        full_name = os.path.join(dirname, filename)
-                        if IS_DRY_RUN:
-                            log(1, "Would delete: " + filename + " (\"" + description + "\")")
-                        else:
-                            log(1, "Deleting: " + filename + " (\"" + description + "\")")
-                            os.remove(full_name)
-                        DELETED_FILES_COUNT += 1
-                        break
+    if opts.del_ntsc_versions:
+        stages.append((del_pal_or_ntsc_files, True))
 
-    return 0
+    if opts.del_pal_versions:
+        stages.append((del_pal_or_ntsc_files, False))
 
+    if opts.del_roms_without_image:
+        stages.append((del_roms_without_image,))
 
-def del_if_manufacturer_has(path_to_roms_dir, path_to_dat_file, exclusion_list_string):
+    if opts.del_images_without_rom:
+        stages.append((del_images_without_rom,))
 
-    global DELETED_FILES_COUNT
+    if opts.del_first_variants:
+        stages.append((del_variant_files, True))
 
-    log(0, "\nDeleting files with manufacturer matching any of input patterns...\n")
+    if opts.del_last_variants:
+        stages.append((del_variant_files, False))
 
-    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+    if opts.del_variants_with_string:
+        stages.append((del_variant_files_from_string, opts.del_variants_with_string, True))
 
-    if not exclusion_list:
-        return 2
+    if opts.del_variants_without_string:
+        stages.append((del_variant_files_from_string, opts.del_variants_without_string, False))
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            element = tree.findall('.//game[@name="' + rom + '"]/manufacturer')
-            if element:
-                manufacturer = element[0].text
-                for pattern in exclusion_list:
-                    if pattern.lower() in manufacturer.lower():
-                        full_name = os.path.join(dirname, filename)
-                        if IS_DRY_RUN:
-                            log(1, "Would delete: " + filename + " (\"" + manufacturer + "\")")
-                        else:
-                            log(1, "Deleting: " + filename + " (\"" + manufacturer + "\")")
-                            os.remove(full_name)
-                        DELETED_FILES_COUNT += 1
-                        break
+    if opts.keep_best_variant_string:
+        stages.append((del_variant_files_but_best, opts.keep_best_variant_string))
 
-    return 0
+    if opts.del_duplicates:
+        stages.append((del_duplicates, opts.dat_file, opts.reference_roms_dirs))
 
+    if opts.del_content_duplicates:
+        stages.append((del_content_duplicates, opts.dat_file, opts.reference_roms_dirs))
 
-def del_if_comment_has(path_to_roms_dir, path_to_dat_file, exclusion_list_string):
+    if opts.del_roms_clones:
+        stages.append((del_roms_clones, opts.dat_file))
 
-    global DELETED_FILES_COUNT
+    if opts.del_roms_with_samples:
+        stages.append((del_roms_with_samples, opts.dat_file))
 
-    log(0, "\nDeleting files with comment matching any of input patterns...\n")
+    if opts.del_roms_older_than_year:
+        stages.append((del_roms_older_than, opts.dat_file, opts.del_roms_older_than_year))
 
-    exclusion_list = check_and_get_patterns_list(exclusion_list_string)
+    if opts.del_if_description_has_string:
+        stages.append((del_if_description_has, opts.dat_file, opts.del_if_description_has_string))
 
-    if not exclusion_list:
-        return 2
+    if opts.del_if_manufacturer_has_string:
+        stages.append((del_if_manufacturer_has, opts.dat_file, opts.del_if_manufacturer_has_string))
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            element = tree.findall('.//game[@name="' + rom + '"]/comment')
-            if element:
-                comment = element[0].text
-                for pattern in exclusion_list:
-                    if pattern.lower() in comment.lower():
-                        full_name = os.path.join(dirname, filename)
-                        if IS_DRY_RUN:
-                            log(1, "Would delete: " + filename + " (\"" + comment + "\")")
-                        else:
-                            log(1, "Deleting: " + filename + " (\"" + comment + "\")")
-                            os.remove(full_name)
-                        DELETED_FILES_COUNT += 1
-                        break
+    if opts.del_if_comment_has_string:
+        stages.append((del_if_comment_has, opts.dat_file, opts.del_if_comment_has_string))
 
-    return 0
+    if opts.del_if_bios_is_string:
+        stages.append((del_if_bios_is, opts.dat_file, opts.del_if_bios_is_string, True))
 
+    if opts.del_if_bios_isnt_string:
+        stages.append((del_if_bios_is, opts.dat_file, opts.del_if_bios_isnt_string, False))
 
-def del_if_bios_is(path_to_roms_dir, path_to_dat_file, input_bios_list_string, del_on_match):
+    if opts.del_where_string:
+        stages.append((del_where, opts.dat_file, opts.del_where_string))
 
-    global DELETED_FILES_COUNT
+    if opts.audit_zips or opts.del_bad_zips:
+        stages.append((audit_zips, opts.dat_file, bool(opts.del_bad_zips)))
 
-    if del_on_match:
-        log(0, "\nRemoving ROMs matching input BIOS(es)...\n")
-    else:
-        log(0, "\nRemoving ROMs NOT matching input BIOS(es)...\n")
+    # Check input arguments of all stages first, so that nothing is moved nor deleted by any
+    # stage when a later one gets bad arguments
+    for stage in stages:
+        if not check_stage_arguments(stage):
+            return 2
 
-    input_bios_list = check_and_get_bioses_list(input_bios_list_string)
+    if opts.make_flat:
+        CURRENT_RULE = 'make_flat'
+        with phase('make_flat'):
+            status = make_flat(opts.roms_dir, opts.make_flat_on_conflict, plan)
+        if status != 0:
+            return status
 
-    if not input_bios_list:
-        return 2
+    # Load .dat file ROMs from the start, so that it is only parsed once for all stages
+    if opts.audit_zips or opts.del_bad_zips:
+        get_dat_index(opts.dat_file, with_roms=True)
 
-    with open(path_to_dat_file, 'r') as file:
-        tree = ElementTree.parse(file)
-
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            rom = filename.split(".")[0]
-            element = tree.findall('.//game[@name="' + rom + '"]')
-            if element:
-                root, is_bios = get_root_rom(tree, element[0])
-                if root and is_bios:
-                    log(2, rom + " root ROM is a BIOS: " + root)
-                    if (del_on_match and root.lower() in input_bios_list) or\
-                       (not del_on_match and root.lower() not in input_bios_list):
-                        full_name = os.path.join(dirname, filename)
-                        if IS_DRY_RUN:
-                            log(1, "Would delete: " + filename + " (" + root + ")")
-                        else:
-                            log(1, "Deleting: " + filename + " (" + root + ")")
-                            os.remove(full_name)
-                        DELETED_FILES_COUNT += 1
-                elif root:
-                    log(2, rom + " root ROM is no BIOS but: " + root + "; keeping ROM")
-                else:
-                    log(2, rom + " got not root ROM; keeping ROM")
+    with phase('scan'):
+        inventory = Inventory(opts.roms_dir).scan()
 
-    return 0
+    for stage in stages:
+        CURRENT_RULE = stage[0].__name__
+        with phase(stage[0].__name__):
+            status = stage[0](inventory, *stage[1:])
+        if status != 0:
+            return status
+    CURRENT_RULE = None
 
+    with phase('apply_deletions'):
+        status = inventory.apply_deletions()
+    if status != 0:
+        return status
 
-def get_files_count(path_to_roms_dir):
+    if plan is not None:
+        with phase('write_plan'):
+            plan.add_deletions(inventory)
+            status = plan.write(opts.write_plan)
+        if status != 0:
+            return status
 
-    files_count = 0
+    if DELETED_FILES_COUNT == 0:
+        log(1, "No matching file")
+    else:
+        log(1, "\nMatching files count: " + str(DELETED_FILES_COUNT) + " / " + str(get_files_count(inventory)))
 
-    for dirname, dirnames, filenames in os.walk(path_to_roms_dir):
-        for filename in filenames:
-            file_extension  = os.path.splitext(filename)[1]
-            if file_extension != '.png' and file_extension != '.xml' and file_extension != '.txt':
-                files_count += 1
-    
-    return files_count
+    return 0
 
 
 def main(argv=None):
@@ -763,6 +2955,14 @@ def main(argv=None):
     global LOG_LEVEL
     global IS_DRY_RUN
     global DELETED_FILES_COUNT
+    global USE_DAT_CACHE
+    global REBUILD_DAT_CACHE
+    global DAT_STORE
+    global JOBS_COUNT
+    global USE_DIGEST_CACHE
+    global STATS
+    global LOG_FORMAT
+    global SHOW_PROGRESS
     program_name           = os.path.basename(sys.argv[0])
     program_version        = "v%1.1f" % __version__
     program_build_date     = "%s" % __updated__
@@ -772,6 +2972,7 @@ def main(argv=None):
                     '       ' + len(program_name) * ' ' + ' [--del-files-with=STRING]  [--del-files-without=STRING]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-first-variants]     [--del-last-variants]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-variants-with]      [--del-variants-without]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--keep-best-variant=STRING]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-ntsc-versions]      [--del-pal-versions]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-roms-without-image] [--del-images-without-rom]\n' \
                     '       *** Cleaning based on .dat file analysis\n' \
@@ -783,9 +2984,22 @@ def main(argv=None):
                     '       ' + len(program_name) * ' ' + ' [--del-if-comment-has=STRING]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-if-bios-is=STRING]\n' \
                     '       ' + len(program_name) * ' ' + ' [--del-if-bios-isnt=STRING]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--del-where=STRING]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--audit-zips]             [--del-bad-zips]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--no-dat-cache]           [--rebuild-dat-cache]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--dat-store=STRING]\n' \
                     '       *** Other utilities\n' \
-                    '       ' + len(program_name) * ' ' + ' [--make-flat]\n' \
-                    '       ' + len(program_name) * ' ' + ' [--del-duplicates --ref-roms-dir=STRING]\n'
+                    '       ' + len(program_name) * ' ' + ' [--make-flat [--make-flat-on-conflict=STRING]]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--del-duplicates --ref-roms-dir=STRING]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--del-content-duplicates [--ref-roms-dir=STRING]] [--jobs=INT]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--no-digest-cache]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--write-plan=STRING]      [--apply-plan=STRING]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--stats]                  [--stats-json=STRING]\n' \
+                    '       ' + len(program_name) * ' ' + ' [--log-format=STRING]      [--progress]\n'
+
+    # Buffered output is written whatever the way the run ends
+    atexit.register(flush_log)
+    signal.signal(signal.SIGTERM, on_signal)
 
     # Check python version is the minimum expected one
     if sys.version_info[0] < REQUIRED_PYTHON_VERSION:
@@ -829,6 +3043,11 @@ def main(argv=None):
                           action="store_true",
                           dest="make_flat",
                           help="remove any intermediate directory; move all files to the ROMs base directory")
+        parser.add_option("--make-flat-on-conflict",
+                          action="store",
+                          dest="make_flat_on_conflict",
+                          help="when a file to be moved up has the name of an existing one, either 'skip' it or 'rename' it with a number [default: %default]",
+                          metavar="STRING")
         parser.add_option("-w",
                           "--del-files-with",
                           action="store",
@@ -863,6 +3082,11 @@ def main(argv=None):
                           dest="del_variants_without_string",
                           help="in case variants of a ROM are found, delete all variants NOT matching any of the provided string patterns",
                           metavar="STRING")
+        parser.add_option("--keep-best-variant",
+                          action="store",
+                          dest="keep_best_variant_string",
+                          help="in case variants of a ROM are found, only keep the best one: the one with the first region or language of the provided comma separated list, then verified [!], then with the highest revision",
+                          metavar="STRING")
         parser.add_option("-n",
                           "--del-ntsc-versions",
                           action="store_true",
@@ -877,12 +3101,12 @@ def main(argv=None):
                           "--del-roms-without-image",
                           action="store_true",
                           dest="del_roms_without_image",
-                          help="in case a ROM has no PNG image in media/images directory, delete ROM")
+                          help="in case a ROM has no image in media/images, media/screenshots or media/box2d directory, delete ROM")
         parser.add_option("-x",
                           "--del-images-without-rom",
                           action="store_true",
                           dest="del_images_without_rom",
-                          help="in case a PNG image in media/images directory has no ROM, delete PNG")
+                          help="in case an image in media/images, media/screenshots or media/box2d directory has no ROM, delete image")
         parser.add_option("-u",
                           "--del-duplicates",
                           action="store_true",
@@ -890,10 +3114,51 @@ def main(argv=None):
                           help="in case duplicates of ROMs in input directory are found in a reference directory, delete those duplicates")
         parser.add_option("-e",
                           "--ref-roms-dir",
+                          action="append",
+                          dest="reference_roms_dirs",
+                          help="reference input directory, including ROM files; may be set several times",
+                          metavar="STRING")
+        parser.add_option("--del-content-duplicates",
+                          action="store_true",
+                          dest="del_content_duplicates",
+                          help="delete files having the same content (SHA-1) as a file in reference directories, or as another file in input directory")
+        parser.add_option("--no-digest-cache",
+                          action="store_true",
+                          dest="no_digest_cache",
+                          help="do not use nor save cached digests of files; always read files content")
+        parser.add_option("--write-plan",
+                          action="store",
+                          dest="write_plan",
+                          help="execute dry-run, and write files to be moved and deleted to this JSON Lines plan file",
+                          metavar="STRING")
+        parser.add_option("--apply-plan",
+                          action="store",
+                          dest="apply_plan",
+                          help="move and delete files listed in this plan file, but the ones changed since it was written; no other option is needed",
+                          metavar="STRING")
+        parser.add_option("--log-format",
+                          action="store",
+                          dest="log_format",
+                          help="format of output lines: 'text', or 'jsonl' for a JSON object per line, each action on a file having its path, reason and rule [default: %default]",
+                          metavar="STRING")
+        parser.add_option("--progress",
+                          action="store_true",
+                          dest="progress",
+                          help="show a progress line of actions on files, instead of a line per file")
+        parser.add_option("--stats",
+                          action="store_true",
+                          dest="stats",
+                          help="print wall and CPU times of each phase of the run, and counters of what was done")
+        parser.add_option("--stats-json",
                           action="store",
-                          dest="reference_roms_dir",
-                          help="reference input directory, including ROM files",
+                          dest="stats_json",
+                          help="write wall and CPU times of each phase of the run, and counters of what was done, to this JSON file",
                           metavar="STRING")
+        parser.add_option("--jobs",
+                          action="store",
+                          dest="jobs",
+                          help="count of concurrent jobs for I/O bound operations, e.g. files hashing, moving or deleting [default: %default]",
+                          metavar="INT")
         parser.add_option("-c",
                           "--del-roms-clones",
                           action="store_true",
@@ -940,9 +3205,36 @@ def main(argv=None):
                           dest="del_if_bios_isnt_string",
                           help="from input .dat file analysis, delete all ROMs with parent BIOS NOT matching one of the provided BIOS(es)",
                           metavar="STRING")
+        parser.add_option("--del-where",
+                          action="store",
+                          dest="del_where_string",
+                          help="from input .dat file analysis, delete all ROMs matching the provided expression, e.g. \"year < 1990 and (manufacturer ~ 'bootleg' or comment ~ 'imperfect') and not isbios\"",
+                          metavar="STRING")
+        parser.add_option("--audit-zips",
+                          action="store_true",
+                          dest="audit_zips",
+                          help="from input .dat file analysis, report ZIP archives with missing members or wrong CRCs")
+        parser.add_option("--del-bad-zips",
+                          action="store_true",
+                          dest="del_bad_zips",
+                          help="from input .dat file analysis, delete ZIP archives with missing members or wrong CRCs")
+        parser.add_option("--no-dat-cache",
+                          action="store_true",
+                          dest="no_dat_cache",
+                          help="do not use nor save .dat cache files; always parse input .dat file")
+        parser.add_option("--rebuild-dat-cache",
+                          action="store_true",
+                          dest="rebuild_dat_cache",
+                          help="parse input .dat file again and refresh its cache file, even if found up to date")
+        parser.add_option("--dat-store",
+                          action="store",
+                          dest="dat_store",
+                          help="how .dat file games are held in memory: 'index' of game records, 'columns' of arrays, much smaller and faster to query on large .dat files, or 'lazy' index of games locations in .dat file, each game being only parsed when needed, which is fastest to start for a few ROMs [default: %default]",
+                          metavar="STRING")
 
         # Set defaults
-        parser.set_defaults(verbose=str(LOG_LEVEL))
+        parser.set_defaults(verbose=str(LOG_LEVEL), jobs=str(JOBS_COUNT), make_flat_on_conflict='skip', log_format='text',
+                            dat_store=DAT_STORE)
 
         # Process options
         (opts, args) = parser.parse_args(argv)
@@ -950,18 +3242,50 @@ def main(argv=None):
         LOG_LEVEL = int(opts.verbose)
         log(2, "Verbosity level = %s" % opts.verbose)
 
-        if opts.is_dry_run:
+        if opts.is_dry_run or opts.write_plan:
             IS_DRY_RUN = True
         else:
             IS_DRY_RUN = False
         log(2, "Dry-run mode    = %s" % str(IS_DRY_RUN))
 
+        JOBS_COUNT = int(opts.jobs)
+        if JOBS_COUNT < 1:
+            log(0, "ERROR: bad input jobs count (\"" + opts.jobs + "\"); please use a positive integer")
+            return 2
+
+        USE_DAT_CACHE     = not opts.no_dat_cache
+        USE_DIGEST_CACHE  = not opts.no_digest_cache
+        REBUILD_DAT_CACHE = bool(opts.rebuild_dat_cache)
+
+        if opts.dat_store not in ('index', 'columns', 'lazy'):
+            log(0, "ERROR: bad input .dat store (\"" + opts.dat_store + "\"); please use 'index', 'columns' or 'lazy'")
+            return 2
+        DAT_STORE = opts.dat_store
+
+        if opts.log_format not in ('text', 'jsonl'):
+            log(0, "ERROR: bad input log format (\"" + opts.log_format + "\"); please use 'text' or 'jsonl'")
+            return 2
+        LOG_FORMAT    = opts.log_format
+        SHOW_PROGRESS = bool(opts.progress)
+
         # Check some of the options
-        if not opts.roms_dir:
+        if opts.apply_plan and opts.write_plan:
+            log(0, "ERROR: --write-plan and --apply-plan cannot be set together")
+            return 2
+
+        if opts.apply_plan and not os.path.isfile(opts.apply_plan):
+            log(0, "ERROR: " + opts.apply_plan + " file not found")
+            return 2
+
+        if opts.make_flat_on_conflict not in ('skip', 'rename'):
+            log(0, "ERROR: bad input make flat conflict policy (\"" + opts.make_flat_on_conflict + "\"); please use 'skip' or 'rename'")
+            return 2
+
+        if not opts.roms_dir and not opts.apply_plan:
             log(0, "ERROR: missing input path to ROMs directory. Try --help")
             return 2
 
-        if not os.path.isdir(opts.roms_dir):
+        if opts.roms_dir and not os.path.isdir(opts.roms_dir):
             log(0, "ERROR: " + opts.roms_dir + " directory not found")
             return 2
 
@@ -969,13 +3293,14 @@ def main(argv=None):
             log(0, "ERROR: " + opts.dat_file + " file not found")
             return 2
 
-        if opts.del_duplicates and not opts.reference_roms_dir:
+        if opts.del_duplicates and not opts.reference_roms_dirs:
             log(0, "ERROR: setting --del-duplicates requires --ref-roms-dir to be also set")
             return 2
 
-        if opts.reference_roms_dir and not os.path.isdir(opts.reference_roms_dir):
-            log(0, "ERROR: " + opts.reference_roms_dir + " directory not found")
-            return 2
+        for reference_roms_dir in opts.reference_roms_dirs or []:
+            if not os.path.isdir(reference_roms_dir):
+                log(0, "ERROR: " + reference_roms_dir + " directory not found")
+                return 2
 
         if opts.del_duplicates and not opts.dat_file:
             log(0, "ERROR: setting --del-duplicates requires --dat-file to be also set")
@@ -1013,120 +3338,43 @@ def main(argv=None):
             log(0, "ERROR: setting --del-if-bios-isnt requires --dat-file to be also set")
             return 2
 
+        if opts.del_where_string and not opts.dat_file:
+            log(0, "ERROR: setting --del-where requires --dat-file to be also set")
+            return 2
+
+        if opts.audit_zips and not opts.dat_file:
+            log(0, "ERROR: setting --audit-zips requires --dat-file to be also set")
+            return 2
+
+        if opts.del_bad_zips and not opts.dat_file:
+            log(0, "ERROR: setting --del-bad-zips requires --dat-file to be also set")
+            return 2
+
         if opts.dat_file and not os.path.isfile(opts.dat_file):
             log(0, "ERROR: " + opts.dat_file + " file not found")
             return 2
 
     except Exception as error:
+        flush_log()
         indent = len(program_name) * " "
         sys.stderr.write(program_name + ": " + repr(error) + "\n")
         sys.stderr.write(indent + " for help use --help\n")
         return 2
 
-    if opts.make_flat:
-        status = make_flat(opts.roms_dir)
-        if status != 0:
-            return status
-
-    if opts.del_files_without_string:
-        status = del_files_without(opts.roms_dir, opts.del_files_without_string)
-        if status != 0:
-            return status
-
-    if opts.del_files_with_string:
-        status = del_files_with(opts.roms_dir, opts.del_files_with_string)
-        if status != 0:
-            return status
-
-    if opts.del_ntsc_versions:
-        status = del_pal_or_ntsc_files(opts.roms_dir, True)
-        if status != 0:
-            return status
-
-    if opts.del_pal_versions:
-        status = del_pal_or_ntsc_files(opts.roms_dir, False)
-        if status != 0:
-            return status
-
-    if opts.del_roms_without_image:
-        status = del_roms_without_image(opts.roms_dir)
-        if status != 0:
-            return status
-
-    if opts.del_images_without_rom:
-        status = del_images_without_rom(opts.roms_dir)
-        if status != 0:
-            return status
-
-    if opts.del_first_variants:
-        status = del_variant_files(opts.roms_dir, True)
-        if status != 0:
-            return status
-
-    if opts.del_last_variants:
-        status = del_variant_files(opts.roms_dir, False)
-        if status != 0:
-            return status
-            
-    if opts.del_variants_with_string:
-        status = del_variant_files_from_string(opts.roms_dir, opts.del_variants_with_string, True)
-        if status != 0:
-            return status
-
-    if opts.del_variants_without_string:
-        status = del_variant_files_from_string(opts.roms_dir, opts.del_variants_without_string, False)
-        if status != 0:
-            return status
-            
-    if opts.del_duplicates:
-        status = del_duplicates(opts.roms_dir, opts.dat_file, opts.reference_roms_dir)
-        if status != 0:
-            return status
-
-    if opts.del_roms_clones:
-        status = del_roms_clones(opts.roms_dir, opts.dat_file)
-        if status != 0:
-            return status
-
-    if opts.del_roms_with_samples:
-        status = del_roms_with_samples(opts.roms_dir, opts.dat_file)
-        if status != 0:
-            return status
-
-    if opts.del_roms_older_than_year:
-        status = del_roms_older_than(opts.roms_dir, opts.dat_file, opts.del_roms_older_than_year)
-        if status != 0:
-            return status
-
-    if opts.del_if_description_has_string:
-        status = del_if_description_has(opts.roms_dir, opts.dat_file, opts.del_if_description_has_string)
-        if status != 0:
-            return status
-
-    if opts.del_if_manufacturer_has_string:
-        status = del_if_manufacturer_has(opts.roms_dir, opts.dat_file, opts.del_if_manufacturer_has_string)
-        if status != 0:
-            return status
+    # Statistics are collected all along, then reported whatever the returned status
+    if opts.stats or opts.stats_json:
+        STATS = Stats()
 
-    if opts.del_if_comment_has_string:
-        status = del_if_comment_has(opts.roms_dir, opts.dat_file, opts.del_if_comment_has_string)
-        if status != 0:
-            return status
+    with phase('total'):
+        status = clean_roms(opts)
 
-    if opts.del_if_bios_is_string:
-        status = del_if_bios_is(opts.roms_dir, opts.dat_file, opts.del_if_bios_is_string, True)
-        if status != 0:
-            return status
+    if STATS is not None:
+        STATS.report(opts.stats, opts.stats_json)
 
-    if opts.del_if_bios_isnt_string:
-        status = del_if_bios_is(opts.roms_dir, opts.dat_file, opts.del_if_bios_isnt_string, False)
-        if status != 0:
-            return status
+    flush_log()
+    PROGRESS.clear()
 
-    if DELETED_FILES_COUNT == 0:
-        log(1, "No matching file")
-    else:
-        log(1, "\nMatching files count: " + str(DELETED_FILES_COUNT) + " / " + str(get_files_count(opts.roms_dir)))
+    return status
 
 
 # Module run in main mode
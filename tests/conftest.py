@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Reset pyrsc global settings for each test, so that none of them leaks from a test to the
+next one, e.g. once changed by a call to main().
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+
+@pytest.fixture(autouse=True)
+def pyrsc_settings(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(pyrsc, 'LOG_LEVEL', -1)
+    monkeypatch.setattr(pyrsc, 'IS_DRY_RUN', True)
+    monkeypatch.setattr(pyrsc, 'DELETED_FILES_COUNT', 0)
+    monkeypatch.setattr(pyrsc, 'USE_DAT_CACHE', False)
+    monkeypatch.setattr(pyrsc, 'REBUILD_DAT_CACHE', False)
+    monkeypatch.setattr(pyrsc, 'DAT_STORE', 'index')
+    monkeypatch.setattr(pyrsc, 'DAT_INDEXES', {})
+    monkeypatch.setattr(pyrsc, 'USE_DIGEST_CACHE', False)
+    monkeypatch.setattr(pyrsc, 'JOBS_COUNT', pyrsc.JOBS_COUNT)
+    monkeypatch.setattr(pyrsc, 'STATS', None)
+    monkeypatch.setattr(pyrsc, 'LOG_FORMAT', 'text')
+    monkeypatch.setattr(pyrsc, 'SHOW_PROGRESS', False)
+    monkeypatch.setattr(pyrsc, 'CURRENT_RULE', None)
+    # Cache files, if ever enabled by a test, are written apart from the user ones
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check arguments of all cleaning stages are checked once, before any file is deleted.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+DAT = '''<?xml version="1.0"?>
+<datafile>
+  <game name="a">
+    <description>A</description>
+    <year>1985</year>
+  </game>
+</datafile>
+'''
+
+
+@pytest.mark.parametrize('bad_arguments', [['--keep-best-variant', ','],
+                                           ['-o', 'pattern'],
+                                           ['-a', 'year'],
+                                           ['--del-if-bios-is', '-'],
+                                           ['--del-where', 'year <']])
+def test_bad_stage_arguments_delete_nothing(tmp_path, capsys, bad_arguments):
+
+    for name in ('a.zip', 'b.zip'):
+        open(str(tmp_path / name), 'w').close()
+    path_to_dat_file = str(tmp_path / 'test.dat')
+    with open(path_to_dat_file, 'w') as dat_file:
+        dat_file.write(DAT)
+
+    status = pyrsc.main(['-r', str(tmp_path), '-d', path_to_dat_file, '--no-dat-cache',
+                         '-w', '*a.zip*'] + bad_arguments)
+    pyrsc.flush_log()
+
+    assert status == 2
+    assert 'Deleting' not in capsys.readouterr().out
+    assert os.path.isfile(str(tmp_path / 'a.zip'))
+
+
+def test_patterns_are_logged_once(tmp_path, capsys):
+
+    open(str(tmp_path / 'a.zip'), 'w').close()
+
+    status = pyrsc.main(['-r', str(tmp_path), '--dry-run', '-v', '2', '-w', '*a.zip* *b.zip*'])
+    pyrsc.flush_log()
+
+    assert status == 0
+    output = capsys.readouterr().out
+    assert output.count("Adding pattern: 'a.zip'") == 1
+    assert output.count("Adding pattern: 'b.zip'") == 1
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check a .dat file is only loaded once for all stages, even when it has no game.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+
+def test_dat_file_with_no_game_is_loaded_once(tmp_path, monkeypatch):
+
+    path_to_dat_file = str(tmp_path / 'empty.dat')
+    with open(path_to_dat_file, 'w') as dat_file:
+        dat_file.write('<?xml version="1.0"?>\n<datafile>\n</datafile>\n')
+
+    loads          = []
+    load_dat_index = pyrsc.load_dat_index
+
+    def load_dat_index_counted(path_to_dat_file, with_roms=False):
+        loads.append(path_to_dat_file)
+        return load_dat_index(path_to_dat_file, with_roms)
+
+    monkeypatch.setattr(pyrsc, 'load_dat_index', load_dat_index_counted)
+
+    dat_index = pyrsc.get_dat_index(path_to_dat_file)
+
+    assert len(dat_index) == 0
+    assert pyrsc.get_dat_index(path_to_dat_file) is dat_index
+    assert loads == [path_to_dat_file]
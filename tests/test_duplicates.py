@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check --del-content-duplicates never removes reference files, even when a reference
+directory is found in the ROMs directory under another path.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+
+def test_del_content_duplicates_keeps_reference_files_in_roms_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(pyrsc, 'IS_DRY_RUN', False)
+    monkeypatch.chdir(str(tmp_path))
+
+    os.makedirs(os.path.join('e', 'sub'))
+    for name, content in ((os.path.join('e', 'sub', 'a.zip'), 'same'), (os.path.join('e', 'b.zip'), 'same'),
+                          (os.path.join('e', 'c.zip'), 'other')):
+        with open(name, 'w') as file:
+            file.write(content)
+
+    inventory = pyrsc.Inventory('e').scan()
+
+    assert pyrsc.del_content_duplicates(inventory, None, [str(tmp_path / 'e' / 'sub')]) == 0
+    assert sorted(file.name for file in inventory.files if file.is_deleted) == ['b.zip']
+
+    assert inventory.apply_deletions() == 0
+    assert os.path.isfile(os.path.join('e', 'sub', 'a.zip'))
+    assert not os.path.exists(os.path.join('e', 'b.zip'))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check --make-flat never replaces a file, even one whose name only differs by case, as they
+conflict on case-insensitive file systems.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+
+@pytest.fixture
+def roms_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(pyrsc, 'IS_DRY_RUN', False)
+
+    os.makedirs(str(tmp_path / 'sub'))
+    with open(str(tmp_path / 'Game.zip'), 'w') as file:
+        file.write('top')
+    with open(str(tmp_path / 'sub' / 'game.zip'), 'w') as file:
+        file.write('sub')
+
+    return tmp_path
+
+
+def read(path):
+
+    with open(str(path)) as file:
+        return file.read()
+
+
+def test_make_flat_skips_names_differing_by_case(roms_dir):
+
+    assert pyrsc.make_flat(str(roms_dir), 'skip') == 0
+
+    assert sorted(os.listdir(str(roms_dir))) == ['Game.zip', 'sub']
+    assert read(roms_dir / 'Game.zip') == 'top'
+    assert read(roms_dir / 'sub' / 'game.zip') == 'sub'
+
+
+def test_make_flat_renames_names_differing_by_case(roms_dir):
+
+    assert pyrsc.make_flat(str(roms_dir), 'rename') == 0
+
+    assert sorted(os.listdir(str(roms_dir))) == ['Game.zip', 'game (1).zip']
+    assert read(roms_dir / 'Game.zip') == 'top'
+    assert read(roms_dir / 'game (1).zip') == 'sub'
+
+
+def test_move_file_does_not_replace_destination(roms_dir):
+
+    with pytest.raises(FileExistsError):
+        pyrsc.move_file(str(roms_dir / 'sub' / 'game.zip'), str(roms_dir / 'Game.zip'))
+
+    assert read(roms_dir / 'Game.zip') == 'top'
+    assert read(roms_dir / 'sub' / 'game.zip') == 'sub'
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check --del-roms-without-image and --del-images-without-rom tell images directories apart,
+whatever the path of the ROMs directory, e.g. ".".
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+
+@pytest.fixture
+def roms_dir(tmp_path):
+
+    os.makedirs(str(tmp_path / 'media' / 'images'))
+    for name in ('a.zip', 'b.zip', os.path.join('media', 'images', 'a.png'), os.path.join('media', 'images', 'c.png')):
+        open(str(tmp_path / name), 'w').close()
+
+    return tmp_path
+
+
+def get_deleted_names(inventory):
+
+    return sorted(file.name for file in inventory.files if file.is_deleted)
+
+
+@pytest.mark.parametrize('path_to_roms_dir', ['.', 'ROMS_DIR'])
+def test_del_roms_without_image(roms_dir, monkeypatch, path_to_roms_dir):
+
+    monkeypatch.chdir(str(roms_dir))
+    if path_to_roms_dir == 'ROMS_DIR':
+        path_to_roms_dir = str(roms_dir)
+
+    inventory = pyrsc.Inventory(path_to_roms_dir).scan()
+
+    assert pyrsc.del_roms_without_image(inventory) == 0
+    assert get_deleted_names(inventory) == ['b.zip']
+
+
+@pytest.mark.parametrize('path_to_roms_dir', ['.', os.path.join('media', 'images')])
+def test_del_images_without_rom(roms_dir, monkeypatch, path_to_roms_dir):
+
+    monkeypatch.chdir(str(roms_dir))
+
+    inventory = pyrsc.Inventory(path_to_roms_dir).scan()
+
+    assert pyrsc.del_images_without_rom(inventory) == 0
+    assert get_deleted_names(inventory) == ['c.png']
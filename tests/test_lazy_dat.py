@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check the lazy .dat store decodes games as declared by the XML prolog of the .dat file,
+and skips games which could not be parsed.
+"""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+DAT = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<datafile>
+  <game name="caf\xe9">
+    <description>Caf\xe9</description>
+    <manufacturer>Soci\xe9t\xe9</manufacturer>
+  </game>
+  <game name="broken">
+    <description>Broken</manufacturer>
+  </game>
+  <game name="pacman">
+    <description>Pac-Man</description>
+    <manufacturer>Namco</manufacturer>
+  </game>
+</datafile>
+'''
+
+
+def get_lazy_dat_index(tmp_path):
+
+    path_to_dat_file = str(tmp_path / 'latin1.dat')
+    with open(path_to_dat_file, 'w', encoding='latin-1') as dat_file:
+        dat_file.write(DAT)
+
+    return pyrsc.load_lazy_dat_index(path_to_dat_file)
+
+
+def test_lazy_dat_index_decodes_declared_encoding(tmp_path):
+
+    dat_index = get_lazy_dat_index(tmp_path)
+
+    assert 'caf\xe9' in dat_index
+    assert dat_index.get('caf\xe9').manufacturer == 'Soci\xe9t\xe9'
+    assert dat_index.get_matching('manufacturer', re.compile('soci\xe9t\xe9', re.IGNORECASE)) == \
+        {'caf\xe9': 'Soci\xe9t\xe9'}
+
+
+def test_lazy_dat_index_skips_unparsable_games(tmp_path):
+
+    dat_index = get_lazy_dat_index(tmp_path)
+
+    assert dat_index.get('broken') is None
+    assert sorted(game.name for game in dat_index.iter_games()) == ['caf\xe9', 'pacman']
+    assert dat_index.get_matching('manufacturer', re.compile('namco', re.IGNORECASE)) == {'pacman': 'Namco'}
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check --del-first-variants and --del-last-variants grouping against the former pairwise
+loop over all files, whatever the order files were scanned in.
+"""
+
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+TITLES  = ['Balloon Fight', 'Tetris', 'Zelda', 'Golf', 'Kirby']
+REGIONS = ['(Europe)', '(USA)', '(Japan)', '(World)', '(Europe) (Rev 1)', '(USA) (Beta)']
+
+
+# Former implementation, comparing each file with all files found before it
+def get_deleted_by_pairwise_loop(files, del_first_variants):
+
+    files_list = [{'parent_dir': file.parent_dir, 'name': file.name, 'rom': file.get_rom_name().group_key,
+                   'to_be_deleted': False} for file in files]
+
+    for file in files_list:
+        for file2 in files_list:
+            if file['parent_dir'] == file2['parent_dir']:
+                if file['name'] == file2['name']:
+                    break
+                else:
+                    if file['rom'] == file2['rom'] and not file2['to_be_deleted']:
+                        if del_first_variants:
+                            file2['to_be_deleted'] = True
+                        else:
+                            file['to_be_deleted'] = True
+                        break
+
+    return set(os.path.join(file['parent_dir'], file['name']) for file in files_list if file['to_be_deleted'])
+
+
+def generate_roms(path, rng):
+
+    for dirname in ('', 'nes', os.path.join('nes', 'hacks'), 'snes'):
+        os.makedirs(os.path.join(path, dirname), exist_ok=True)
+        for title in TITLES:
+            for region in rng.sample(REGIONS, rng.randint(1, len(REGIONS))):
+                open(os.path.join(path, dirname, title + ' ' + region + '.zip'), 'w').close()
+        # Untagged files have no variant, but are grouped with same names, e.g. images
+        open(os.path.join(path, dirname, 'Golf.zip'), 'w').close()
+        open(os.path.join(path, dirname, 'Golf.png'), 'w').close()
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('del_first_variants', [True, False])
+def test_del_variant_files_matches_pairwise_loop_on_shuffled_files(tmp_path, seed, del_first_variants):
+
+    rng = random.Random(seed)
+    generate_roms(str(tmp_path), rng)
+
+    inventory = pyrsc.Inventory(str(tmp_path)).scan()
+    rng.shuffle(inventory.files)
+    expected = get_deleted_by_pairwise_loop(inventory.files, del_first_variants)
+
+    assert pyrsc.del_variant_files(inventory, del_first_variants) == 0
+
+    assert set(file.full_name for file in inventory.files if file.is_deleted) == expected
+    assert expected
+
+
+def test_del_variant_files_but_best_keeps_all_parts_of_best_variant(tmp_path):
+
+    names = ['Game (Europe) (Track 1).bin', 'Game (Europe) (Track 2).bin', 'Game (Europe).cue',
+             'Game (USA) (Track 1).bin', 'Game (USA) (Track 2).bin', 'Game (USA).cue',
+             'Mario (Europe) (Disc 1).chd', 'Mario (Europe) (Disc 2).chd', 'Mario (Japan) (Disc 1).chd',
+             'Tetris (Japan).zip', 'Tetris (USA).zip', 'Tetris (USA) (Rev 1).zip', 'Tetris (USA) (Rev 1).png',
+             'Tetris (World) [!].zip', 'Tetris.zip']
+    for name in names:
+        open(str(tmp_path / name), 'w').close()
+
+    inventory = pyrsc.Inventory(str(tmp_path)).scan()
+
+    assert pyrsc.del_variant_files_but_best(inventory, "Europe,USA,World,Japan") == 0
+
+    assert sorted(file.name for file in inventory.files if file.is_deleted) == \
+        ['Game (USA) (Track 1).bin', 'Game (USA) (Track 2).bin', 'Game (USA).cue', 'Mario (Japan) (Disc 1).chd',
+         'Tetris (Japan).zip', 'Tetris (USA).zip', 'Tetris (World) [!].zip']
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check archives audit against .dat file ROMs, for both split and non-merged sets.
+"""
+
+import os
+import sys
+import zipfile
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pyrsc import pyrsc
+
+P1 = b'parent rom'
+C1 = b'clone rom'
+C2 = b'other clone rom'
+
+DAT = '''<?xml version="1.0"?>
+<datafile>
+  <game name="pgame">
+    <description>Parent</description>
+    <rom name="p1.bin" size="%d" crc="%08x"/>
+  </game>
+  <game name="cgame" cloneof="pgame" romof="pgame">
+    <description>Clone</description>
+    <rom name="p1.bin" merge="p1.bin" size="%d" crc="%08x"/>
+    <rom name="c1.bin" size="%d" crc="%08x"/>
+  </game>
+  <game name="dgame" cloneof="pgame" romof="pgame">
+    <description>Other clone</description>
+    <rom name="p1.bin" merge="p1.bin" size="%d" crc="%08x"/>
+    <rom name="c2.bin" size="%d" crc="%08x"/>
+  </game>
+</datafile>
+''' % (len(P1), zlib.crc32(P1), len(P1), zlib.crc32(P1), len(C1), zlib.crc32(C1),
+       len(P1), zlib.crc32(P1), len(C2), zlib.crc32(C2))
+
+
+def write_zip(path, members):
+
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        for name, data in members.items():
+            zip_file.writestr(name, data)
+
+
+def test_audit_zips_split_and_non_merged_sets(tmp_path):
+
+    path_to_dat_file = str(tmp_path / 'test.dat')
+    with open(path_to_dat_file, 'w') as dat_file:
+        dat_file.write(DAT)
+
+    roms_dir = tmp_path / 'roms'
+    roms_dir.mkdir()
+    write_zip(str(roms_dir / 'pgame.zip'), {'p1.bin': P1})
+    # Split set clone, only holding its own ROM
+    write_zip(str(roms_dir / 'cgame.zip'), {'c1.bin': C1})
+    # Non-merged set clone, missing its own ROM
+    write_zip(str(roms_dir / 'dgame.zip'), {'p1.bin': P1})
+
+    inventory = pyrsc.Inventory(str(roms_dir)).scan()
+
+    assert pyrsc.audit_zips(inventory, path_to_dat_file, True) == 0
+    assert sorted(file.name for file in inventory.files if file.is_deleted) == ['dgame.zip']
+
+
+def test_audit_zips_never_deletes_archives_failing_to_be_read(tmp_path, monkeypatch):
+
+    path_to_dat_file = str(tmp_path / 'test.dat')
+    with open(path_to_dat_file, 'w') as dat_file:
+        dat_file.write(DAT)
+
+    roms_dir = tmp_path / 'roms'
+    roms_dir.mkdir()
+    write_zip(str(roms_dir / 'pgame.zip'), {'p1.bin': P1})
+    with open(str(roms_dir / 'cgame.zip'), 'w') as zip_file:
+        zip_file.write('not a ZIP archive')
+
+    # Reading a complete archive fails, as on a share gone offline
+    get_zip_members = pyrsc.get_zip_members
+
+    def get_zip_members_failing(path_to_zip_file):
+        if os.path.basename(path_to_zip_file) == 'pgame.zip':
+            raise PermissionError(13, "Permission denied", path_to_zip_file)
+        return get_zip_members(path_to_zip_file)
+
+    monkeypatch.setattr(pyrsc, 'get_zip_members', get_zip_members_failing)
+
+    inventory = pyrsc.Inventory(str(roms_dir)).scan()
+
+    assert pyrsc.audit_zips(inventory, path_to_dat_file, True) == 0
+    assert sorted(file.name for file in inventory.files if file.is_deleted) == ['cgame.zip']